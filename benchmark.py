@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import rconfig
+import rdns
+import rresolver
+import rvector
+
+# Замеры фаз: разбор конфига, DNS, агрегация, установка и удаление маршрутов.
+# Установка идёт в отдельном сетевом пространстве имён на фиктивном
+# интерфейсе, поэтому root не нужен: скрипт сам перезапускается через
+# `unshare --user --map-root-user --net`.
+#
+#   ./benchmark.py --sizes=1000,10000 --output=bench.json
+#   ./benchmark.py --startup --binary=dist/route-manager/route-manager
+
+SIZES = (1000, 10000, 100000, 1000000)
+# Доля строк route с доменными именами в синтетическом конфиге
+HOSTNAME_SHARE = 0.01
+BENCH_IFACE = "bench0"
+BENCH_ADDRESS = "10.200.0.2"
+NETNS_FLAG = "ROUTE_BENCH_NETNS"
+# Сколько раз запускаем хук при замере холодного старта
+STARTUP_RUNS = 20
+# На скольких маршрутах сравнивать с прежним путём (pyroute2, сообщение на
+# вызов) и с ip -batch: скорость у них от размера не зависит
+BASELINE_ROUTES = 10000
+
+def generate_config(path: str, lines: int, seed: int = 0, hostname_share: float = HOSTNAME_SHARE,
+                    ipv6_share: float = 0.0):
+    """Синтетический routes.conf: /24, /32, доля ipv6_share строк route-ipv6
+    (/48 и /128 из 2001:db8::/32) и немного доменных имён"""
+    rng = random.Random(seed)
+    hostnames = []
+    with open(path, 'w') as f:
+        f.write("# Синтетический конфиг для benchmark.py\n")
+        for i in range(lines):
+            if rng.random() < hostname_share:
+                hostname = f"host{i}.bench.test"
+                hostnames.append(hostname)
+                f.write(f"route {hostname} 255.255.255.255 vpn_gateway\n")
+                continue
+            if rng.random() < ipv6_share:
+                address = 0x20010DB8 << 96 | rng.getrandbits(96)
+                prefixlen = 48 if rng.random() < 0.5 else 128
+                address &= ((1 << prefixlen) - 1) << (128 - prefixlen)
+                network = socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, 'big'))
+                f.write(f"route-ipv6 {network}/{prefixlen}\n")
+                continue
+            address = rng.getrandbits(32)
+            if rng.random() < 0.5:
+                address &= 0xFFFFFF00
+                mask = "255.255.255.0"
+            else:
+                mask = "255.255.255.255"
+            f.write(f"route {socket.inet_ntoa(struct.pack('!I', address))} {mask} vpn_gateway\n")
+    return hostnames
+
+
+class StubResolver:
+    """Локальный DNS на UDP: на любое имя отвечает A-записью из хэша имени"""
+
+    def __init__ (self, address: str = '127.0.0.1', port: int = rdns.DNS_PORT, ttl: int = 300):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.address = address
+        self.ttl = ttl
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def answer(self, data: bytes) -> bytes:
+        qid = struct.unpack_from('!H', data, 0)[0]
+        name, offset = rdns.decode_name(data, 12)
+        question = data[12:offset + 4]
+        ip = hashlib.sha256(name.encode()).digest()[:4]
+        record = b'\xc0\x0c' + struct.pack('!HHIH', rdns.TYPE_A, 1, self.ttl, 4) + ip
+        return struct.pack('!HHHHHH', qid, 0x8180, 1, 1, 0, 0) + question + record
+
+    def serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(512)
+                self.sock.sendto(self.answer(data), peer)
+            except OSError:
+                return
+            except (struct.error, IndexError):
+                continue
+
+    def close(self):
+        self.sock.close()
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def load_route_manager():
+    """route-manager.py из-за дефиса не импортируется обычным import"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'route-manager.py')
+    spec = importlib.util.spec_from_file_location('route_manager', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def setup_interface():
+    """Фиктивный интерфейс с адресом внутри пространства имён"""
+    import rpyroute
+    with rpyroute.IPRoute() as ipr:
+        ipr.link('set', index=ipr.link_lookup(ifname='lo')[0], state='up')
+        try:
+            ipr.link('add', ifname=BENCH_IFACE, kind='dummy')
+        except Exception:
+            # Нет модуля dummy — подойдёт и veth
+            ipr.link('add', ifname=BENCH_IFACE, kind='veth', peer=f'{BENCH_IFACE}p')
+            ipr.link('set', index=ipr.link_lookup(ifname=f'{BENCH_IFACE}p')[0], state='up')
+        index = ipr.link_lookup(ifname=BENCH_IFACE)[0]
+        ipr.addr('add', index=index, address=BENCH_ADDRESS, prefixlen=16)
+        ipr.link('set', index=index, state='up')
+
+
+def baseline_pyroute2(requests, window: int) -> float:
+    """Прежний путь: AsyncIPRoute.route на каждое сообщение, window в полёте"""
+    import asyncio
+    import rpyroute
+
+    async def install():
+        ipr = rpyroute.AsyncIPRoute()
+        limit = asyncio.Semaphore(window)
+
+        async def one(request):
+            async with limit:
+                try:
+                    await ipr.route('add', **request)
+                except Exception:
+                    pass
+
+        try:
+            await asyncio.gather(*(one(request) for request in requests))
+        finally:
+            ipr.close()
+
+    _, seconds = timed(asyncio.run, install())
+    return seconds
+
+
+def baseline_ip_batch(requests, workdir: str):
+    """Те же маршруты через ip -batch; None, если ip нет"""
+    batch_file = os.path.join(workdir, 'routes.batch')
+    with open(batch_file, 'w') as f:
+        for request in requests:
+            via = f" via {request['gateway']}" if 'gateway' in request else ''
+            f.write(f"route add {request['dst']}{via} dev {BENCH_IFACE} proto {request['proto']}\n")
+    try:
+        _, seconds = timed(subprocess.run, ['ip', '-force', '-batch', batch_file],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    except OSError:
+        return None
+    return seconds
+
+
+def bench_baselines(manager, workdir: str, args) -> dict:
+    """Скорость установки без журнала и плана: BulkRoute против pyroute2 и ip -batch"""
+    routes = list(itertools.islice(manager.routes, BASELINE_ROUTES))
+    requests = [{**manager.route_request(route), 'proto': manager.proto} for route in routes]
+    result = {'baseline_routes': len(routes)}
+
+    def clear():
+        manager.bulk.run('del', zip(routes, requests))
+
+    result['bulk_s'] = timed(manager.bulk.run, 'add', zip(routes, requests))[1]
+    clear()
+    result['pyroute2_s'] = baseline_pyroute2(requests, args.window)
+    clear()
+    result['ip_batch_s'] = baseline_ip_batch(requests, workdir)
+    clear()
+    for name in ('bulk', 'pyroute2', 'ip_batch'):
+        if result[f'{name}_s']:
+            result[f'{name}_routes_per_s'] = round(len(routes) / result[f'{name}_s'])
+    if result.get('pyroute2_s'):
+        result['speedup_vs_pyroute2'] = round(result['pyroute2_s'] / result['bulk_s'], 1)
+    return result
+
+
+def bench_size(lines: int, workdir: str, args, stub) -> dict:
+    config_file = os.path.join(workdir, f'routes_{lines}.conf')
+    hostnames = generate_config(config_file, lines, seed=lines, ipv6_share=args.ipv6_share)
+    result = {'lines': lines, 'hostnames': len(hostnames)}
+
+    # Разбор без DNS и без агрегации: только чтение и регулярки
+    ip_config = os.path.join(workdir, f'routes_{lines}_ip.conf')
+    with open(config_file) as src, open(ip_config, 'w') as dst:
+        for line in src:
+            if '.bench.test' not in line:
+                dst.write(line)
+    config, result['parse_s'] = timed(rconfig.RouteConfig, ip_config, aggregate=False)
+    result['parsed_routes'] = len(config.routes)
+
+    _, result['aggregate_s'] = timed(config.optimize_routes)
+    result['aggregated_routes'] = len(config.routes)
+
+    if stub is not None and hostnames:
+        resolver = rresolver.Resolver(workers=args.dns_workers)
+        resolver.servers = [stub.address]
+        resolved, result['resolve_s'] = timed(resolver.resolve, hostnames)
+        result['resolved'] = len(resolved)
+        result['resolve_failed'] = len(resolver.failed)
+
+    cache_file = os.path.join(workdir, f'routes_{lines}.rcache')
+    _, result['cache_build_s'] = timed(rconfig.RouteConfig, ip_config, route_cache=cache_file)
+    _, result['cache_load_s'] = timed(rconfig.RouteConfig, ip_config, route_cache=cache_file)
+
+    if args.install:
+        route_manager = load_route_manager()
+        manager = route_manager.RouteManager(
+            config_file=ip_config, iface_name=BENCH_IFACE, window=args.window, rcvbuf=args.rcvbuf,
+            current_routes_file=os.path.join(workdir, f'current_{lines}.json'),
+            dns_cache='', route_cache=cache_file)
+        with manager:
+            manager.get_interface_ip(BENCH_IFACE)
+            added, result['install_s'] = timed(manager.add_routes)
+            result['installed'] = len(added.ok)
+            result['install_failed'] = len(added.failed)
+            removed, result['remove_s'] = timed(manager.remove_routes)
+            result['removed'] = len(removed.ok)
+            # Куда пришло адаптивное окно и буфер приёма, сколько было повторов
+            result['window_final'] = round(manager.bulk.window.limit, 1)
+            result['rcvbuf_final'] = manager.bulk.rcvbuf
+            result['retries'] = manager.stats.snapshot()['counters'].get('netlink_retries', {})
+            if args.baseline:
+                result.update(bench_baselines(manager, workdir, args))
+        if result['install_s']:
+            result['install_routes_per_s'] = round(result['installed'] / result['install_s'])
+
+    if result['parse_s']:
+        result['parse_lines_per_s'] = round(lines / result['parse_s'])
+    return result
+
+
+def bench_startup(workdir: str, args) -> list:
+    """Время запуска хука целиком, как его видит OpenVPN: от exec до выхода.
+
+    up ставит 16 маршрутов из двоичного кэша (первый прогон его строит
+    и в замер не входит), down снимает их. Без установки — только --help.
+    """
+    command = args.binary.split() if args.binary else [sys.executable, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'route-manager.py')]
+    config_file = os.path.join(workdir, 'startup.conf')
+    generate_config(config_file, 16, hostname_share=0)
+    hook = ['--config', config_file, '--dns-cache=', BENCH_IFACE]
+    cases = [('help', ['--help'])]
+    if args.install:
+        cases += [('up', ['up', *hook]), ('down', ['down', *hook])]
+        subprocess.run(command + ['up', *hook], cwd=workdir, stdout=subprocess.DEVNULL, check=True)
+        subprocess.run(command + ['down', *hook], cwd=workdir, stdout=subprocess.DEVNULL, check=True)
+
+    times = {name: [] for name, _ in cases}
+    for _ in range(args.startup_runs):
+        for name, arguments in cases:
+            start = time.perf_counter()
+            subprocess.run(command + arguments, cwd=workdir, stdout=subprocess.DEVNULL, check=True)
+            times[name].append(time.perf_counter() - start)
+    return [{'command': name, 'runs': len(values),
+             'min_s': round(min(values), 4), 'median_s': round(statistics.median(values), 4)}
+            for name, values in times.items()]
+
+
+def run(args) -> dict:
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': rvector.available(),
+        'window': args.window,
+        'rcvbuf': args.rcvbuf,
+        'ipv6_share': args.ipv6_share,
+        'results': [],
+    }
+    if args.startup:
+        report['binary'] = args.binary
+        if args.install:
+            setup_interface()
+        with tempfile.TemporaryDirectory(prefix='route-bench-') as workdir:
+            report['startup'] = bench_startup(workdir, args)
+        return report
+    stub = None
+    if args.install:
+        setup_interface()
+        # В своём пространстве имён порт 53 свободен и доступен
+        stub = StubResolver()
+    with tempfile.TemporaryDirectory(prefix='route-bench-') as workdir:
+        try:
+            # Сообщения route-manager не должны попасть в JSON на stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                for lines in args.sizes:
+                    print(f"[*] {lines} строк...")
+                    report['results'].append(bench_size(lines, workdir, args, stub))
+        finally:
+            if stub is not None:
+                stub.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры скорости route-manager по фазам")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(',')],
+                        default=list(SIZES), help="Размеры конфигов через запятую")
+    parser.add_argument("--window", type=int, default=256, help="Потолок окна пакетной установки")
+    parser.add_argument("--rcvbuf", type=int, default=1 << 20,
+                        help="Начальный буфер приёма netlink-сокета, байт")
+    parser.add_argument("--dns-workers", type=int, default=rresolver.DNS_WORKERS)
+    parser.add_argument("--ipv6-share", type=float, default=0.0,
+                        help="Доля строк route-ipv6 в конфиге (0.5 — поровну IPv4 и IPv6)")
+    parser.add_argument("--no-baseline", dest="baseline", action="store_false",
+                        help="Не сравнивать установку с pyroute2 и ip -batch")
+    parser.add_argument("--no-install", dest="install", action="store_false",
+                        help="Не мерить DNS и установку (не нужен unshare)")
+    parser.add_argument("--startup", action="store_true",
+                        help="Замерить только холодный старт хука (--help, up и down)")
+    parser.add_argument("--startup-runs", type=int, default=STARTUP_RUNS)
+    parser.add_argument("--binary", type=str, default=None,
+                        help="Команда хука для --startup, например собранный PyInstaller "
+                             "(по умолчанию python route-manager.py)")
+    parser.add_argument("--output", type=str, help="Файл для JSON-результатов (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    if args.install and not os.environ.get(NETNS_FLAG):
+        # Перезапускаемся в собственных user+net namespace
+        os.environ[NETNS_FLAG] = '1'
+        os.execvp('unshare', ['unshare', '--user', '--map-root-user', '--net',
+                              sys.executable, os.path.abspath(__file__), *sys.argv[1:]])
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
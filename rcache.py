@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+import rtable
+
+# Разобранный конфиг в двоичном виде: заголовок, немного JSON и колонки
+# RouteTable как есть. При загрузке колонки читаются прямо из mmap.
+
+MAGIC = b'RTC1'
+# 2 — колонки families и networks6 (IPv6)
+VERSION = 2
+HEADER = struct.Struct('=4sHHqq32s32sII')
+# Начало колонок выравниваем по самому крупному элементу
+ALIGN = 8
+
+FLAG_AGGREGATE = 0x0001
+
+def cache_path(config_file: str) -> str:
+    """Файл кэша по умолчанию: рядом с конфигом"""
+    return f'{config_file}.rcache'
+
+
+def file_digest(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def dns_digest(resolved: dict) -> bytes:
+    """Отпечаток ответов DNS, из которых собраны маршруты"""
+    answers = sorted((hostname, sorted(addrs)) for hostname, addrs in resolved.items())
+    return hashlib.sha256(json.dumps(answers).encode()).digest()
+
+
+def _columns(table):
+    # Порядок — по убыванию размера элемента, тогда выравнивание сохраняется
+    return (table.networks6, table.metrics, table.networks, table.gateways, table.prefixlens,
+            table.families)
+
+
+def save(cache_file: str, config_file: str, table, resolved: dict, flags: int = 0, hostnames=()):
+    """Сохраняет таблицу маршрутов вместе с ключом: stat, хэш конфига и ответы DNS.
+
+    hostnames — все имена из конфига, и те, что не разрешились: без них
+    кэш после одного сбоя DNS так и остался бы без маршрута этого имени.
+    """
+    stat = os.stat(config_file)
+    meta = json.dumps({'gateways': table.gateway_names,
+                       'hostnames': sorted(set(resolved) | set(hostnames)),
+                       'networks6': len(table.networks6)}).encode()
+    header = HEADER.pack(MAGIC, VERSION, flags, stat.st_mtime_ns, stat.st_size,
+                         file_digest(config_file), dns_digest(resolved),
+                         len(table), len(meta))
+    padding = -(len(header) + len(meta)) % ALIGN
+
+    tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(header)
+            f.write(meta)
+            f.write(b'\0' * padding)
+            for column in _columns(table):
+                f.write(memoryview(column).cast('B'))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f'[-] Кэш маршрутов {cache_file} не сохранён: {e}')
+
+
+def load(cache_file: str, config_file: str, dns_cache=None, flags: int = 0):
+    """Таблица маршрутов из кэша или None, если конфиг или ответы DNS изменились.
+
+    Колонки таблицы — memoryview поверх mmap, без копирования.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        (magic, version, cache_flags, mtime_ns, size, config_hash, answers_hash,
+         count, meta_len) = HEADER.unpack_from(buffer, 0)
+    except struct.error:
+        return None
+    if magic != MAGIC or version != VERSION or cache_flags != flags:
+        return None
+
+    try:
+        stat = os.stat(config_file)
+    except OSError:
+        return None
+    if stat.st_size != size:
+        return None
+    # Тот же mtime и размер — файл не трогали, хэш не считаем
+    if stat.st_mtime_ns != mtime_ns and file_digest(config_file) != config_hash:
+        return None
+
+    offset = HEADER.size
+    try:
+        meta = json.loads(bytes(buffer[offset:offset + meta_len]))
+    except ValueError:
+        return None
+    offset += meta_len
+    offset += -offset % ALIGN
+
+    if meta['hostnames']:
+        # Маршруты из имён годны, пока в кэше DNS свежие и те же самые адреса
+        if dns_cache is None:
+            return None
+        resolved = {}
+        for hostname in meta['hostnames']:
+            cached = dns_cache.get(hostname)
+            # Имя, которое не разрешилось, — тоже промах: пусть разрешится заново
+            if cached is None or not cached[1] or not cached[0]:
+                return None
+            resolved[hostname] = cached[0]
+        if dns_digest(resolved) != answers_hash:
+            return None
+
+    table = rtable.RouteTable()
+    # Длина networks6 своя (по две половины на сеть IPv6), остальные — по строке
+    lengths = [meta.get('networks6', 0)] + [count] * (len(_columns(table)) - 1)
+    if offset + sum(length * column.itemsize for length, column in zip(lengths, _columns(table))) > len(buffer):
+        return None
+    view = memoryview(buffer)
+    columns = []
+    for length, column in zip(lengths, _columns(table)):
+        length *= column.itemsize
+        columns.append(view[offset:offset + length].cast(column.typecode))
+        offset += length
+    (table.networks6, table.metrics, table.networks, table.gateways, table.prefixlens,
+     table.families) = columns
+    table.gateway_names = meta['gateways']
+    table.gateway_ids = {gateway: i for i, gateway in enumerate(table.gateway_names)}
+    table.buffer = buffer
+    return table
@@ -7,19 +7,56 @@ import os
 import ipaddress
 from collections import defaultdict
 
+import rcache
+import rdnscache
+import rimport
+import rresolver
+import rstats
+import rtable
+import rvector
+
+# Сколько строк route разбираем за раз: в пределах пачки имена
+# разрешаются параллельно, а память не зависит от размера файла
+STREAM_BATCH = 1024
+
 class RouteConfig:
     """Извлекает маршруты из конфига OpenVPN"""
-    routes = []
+    routes = rtable.RouteTable()
     
-    def __init__ (self, config_file=None):
+    def __init__ (self, config_file=None, dns_workers=rresolver.DNS_WORKERS, dns_timeout=rresolver.DNS_TIMEOUT,
+                  dns_cache=None, aggregate=True, lazy=False, route_cache=None, stats=None):
         self.counter = 0
-        self.routes = []
-        self.route_regex = re.compile(r'^\s*route\s+(?P<route>.*)')
+        # stats — rstats.Stats, куда пишется время фаз и итоги DNS
+        self.stats = stats if stats is not None else rstats.Stats()
+        self.aggregate = aggregate
+        self.routes = rtable.RouteTable()
+        # dns_cache — путь к файлу кэша DNS, None — без кэша
+        self.dns_cache = rdnscache.DnsCache(dns_cache) if dns_cache else None
+        self.resolver = rresolver.Resolver(workers=dns_workers, timeout=dns_timeout, cache=self.dns_cache)
+        self.resolved = {}
+        # Все ответы DNS, из которых собраны маршруты (для ключа route_cache)
+        self.answers = {}
+        # Все доменные имена конфига, и неразрешившиеся тоже (для ключа route_cache)
+        self.hostnames = set()
+        # route_cache — файл двоичного кэша разобранных маршрутов, None — без него
+        self.route_cache = route_cache
+        # route и route-ipv6 (адрес/длина, как в OpenVPN)
+        self.route_regex = re.compile(r'^\s*route(?P<ipv6>-ipv6)?\s+(?P<route>.*)')
+        # route-domain example.com [vpn_gateway|net_gateway] [metric N] — см. rdomains
+        self.domain_regex = re.compile(r'^\s*route-domain\s+(?P<domain>.*)')
+        # route-import формат файл [параметры] — см. rimport
+        self.import_regex = re.compile(r'^\s*route-import\s+(?P<feed>.*)')
         self.config_file = config_file
         self.check_config()
+        # Файл целиком больше не читается, читаем построчно в iter_lines
         self.config_content = None
         self.openvpn_conf()
-        self.extract_routes()
+        # lazy — маршруты не разбираются сразу, их отдаёт iter_routes
+        if not lazy:
+            with self.stats.phase('config'):
+                if not self.load_compiled():
+                    self.extract_routes()
+                    self.save_compiled()
         
     def __enter__ (self):
         return self
@@ -32,61 +69,141 @@ class RouteConfig:
         try:
             socket.inet_aton(address)
             return True
+        except socket.error:
+            pass
+        try:
+            socket.inet_pton(socket.AF_INET6, address)
+            return True
         except socket.error:
             return False
 
     def openvpn_conf(self):
+        if not os.path.isfile(self.config_file):
+            raise Exception(f"Ошибка: файл {self.config_file} не найден")
+
+    def iter_lines(self):
+        """Строки конфига по одной, без чтения файла в память"""
         try:
             with open(self.config_file, 'r') as f:
-                self.config_content = f.read()
+                yield from f
         except FileNotFoundError:
             raise Exception(f"Ошибка: файл {self.config_file} не найден")
+
+    def iter_confs(self):
+        """Аргументы строк route, уже разбитые на слова.
+
+        Запись адрес/длина разбивается на два слова, как адрес и маска
+        в route, поэтому дальше строки route-ipv6 разбираются тем же путём.
+        """
+        for line in self.iter_lines():
+            match = self.route_regex.match(line.strip())
+            if match:
+                if match.group('route'):
+                    conf = match.group('route').split()
+                    if '/' in conf[0]:
+                        conf[0:1] = conf[0].split('/', 1)
+                    elif match.group('ipv6'):
+                        conf.insert(1, '128')
+                    yield conf
         
+
+    def iter_domains(self):
+        """Домены из строк route-domain: (домен, метрика, шлюз).
+
+        Читаются отдельным проходом только в режиме domains, поэтому
+        обычный разбор и двоичный кэш маршрутов о них не знают.
+        """
+        for line in self.iter_lines():
+            match = self.domain_regex.match(line.strip())
+            if match and match.group('domain'):
+                conf = match.group('domain').split()
+                metric, gateway = self.route_options(conf)
+                yield conf[0].rstrip('.').lower(), metric, gateway or 'vpn_gateway'
+
+    def iter_imports(self):
+        """Источники префиксов из строк route-import (rimport.Feed)"""
+        base_dir = os.path.dirname(os.path.abspath(self.config_file))
+        for line in self.iter_lines():
+            match = self.import_regex.match(line.strip())
+            if match and match.group('feed'):
+                try:
+                    yield rimport.parse_directive(match.group('feed').split(), base_dir, self.route_options)
+                except ValueError as e:
+                    print(f'[-] {e}')
     
     def append_route(self, network: ipaddress.IPv4Network, metric=None, gateway='vpn_gateway'):
-                
-            route = {
-                'network' : str(network),
-                'address' : str(network.network_address),
-                'netmask' : str(network.netmask),
-                'metric' : metric,
-                'gateway' : gateway,
-                'comment' : ""
-            }
-            
-            # print(f'[{self.counter + 1}]: {route["network"]}')
-            self.routes.append(route)
+            family = socket.AF_INET6 if network.version == 6 else socket.AF_INET
+            self.append_prefix(int(network.network_address), network.prefixlen, metric, gateway, family)
+
+    def append_prefix(self, network: int, prefixlen: int, metric=None, gateway='vpn_gateway',
+                      family=socket.AF_INET):
+            self.routes.append(network, prefixlen, metric, gateway, family)
             self.counter += 1
 
 
     
     def parse_route(self, conf: tuple):
-        ipv4 = None
-        if self.is_ip(conf[0]):
+        for network, prefixlen, metric, gateway, family in self.route_prefixes(conf):
+            self.append_prefix(network, prefixlen, metric, gateway, family)
+
+    def route_prefixes(self, conf: tuple):
+        """Строка route -> список (сеть, длина префикса, метрика, шлюз, семейство)"""
+        prefixes = []
+        if ':' in conf[0]:
+            try:
+                network = rtable.ip6_to_int(conf[0])
+                prefixlen = int(conf[1])
+                if not 0 <= prefixlen <= 128:
+                    raise ValueError(f'Неправильная длина префикса {conf[1]}')
+                if network & ~rtable.prefixlen_to_mask(prefixlen, 128):
+                    raise ValueError(f'{conf[0]}/{prefixlen} has host bits set')
+                prefixes.append((network, prefixlen, socket.AF_INET6))
+            except (ValueError, OSError, IndexError) as e:
+                print(f'Это не IPV6 адрес {e}')
+
+        elif self.is_ip(conf[0]):
             try:
-                ipv4 = ipaddress.IPv4Network(f'{conf[0]}/{conf[1]}')
-            except ValueError as e:
+                network = rtable.ip_to_int(conf[0])
+                prefixlen = rtable.mask_to_prefixlen(conf[1])
+                if network & ~rtable.prefixlen_to_mask(prefixlen):
+                    raise ValueError(f'{conf[0]}/{prefixlen} has host bits set')
+                prefixes.append((network, prefixlen, socket.AF_INET))
+            except (ValueError, OSError) as e:
                 print(f'Это не IPV4 адрес {e}')
             except Exception as e:
                 print(f'Ошибка: {e}')
                 pass
             
         else:
-            try:
-                addr = socket.gethostbyname(conf[0])
-                # print(f'Преобразование из доменного имени: {conf[0]}')
-                # print(type(addr))
-                ipv4 = ipaddress.IPv4Network(f'{addr}/{conf[1]}')
-            except socket.gaierror as g:
-                # print(f'Error: {g}')
-                pass
+            # Имя разрешено заранее в extract_routes, берём все его A- и AAAA-записи.
+            # Маска в строке route — про IPv4, на адреса IPv6 ставится /128
+            for addr in self.resolved.get(conf[0], []):
+                try:
+                    if ':' in addr:
+                        prefixes.append((rtable.ip6_to_int(addr), 128, socket.AF_INET6))
+                        continue
+                    prefixlen = rtable.mask_to_prefixlen(conf[1])
+                    prefixes.append((rtable.ip_to_int(addr) & rtable.prefixlen_to_mask(prefixlen), prefixlen,
+                                     socket.AF_INET))
+                except (ValueError, OSError) as e:
+                    print(f'Ошибка маски для {conf[0]}: {e}')
             
+        metric, gateway = self.route_options(conf)
+        return [(network, prefixlen, metric,
+                 (gateway or 'vpn_gateway') if family == socket.AF_INET6 else gateway, family)
+                for network, prefixlen, family in prefixes]
+
+    def route_options(self, conf: tuple):
+        """Метрика и шлюз из строки route"""
         metric = None
         gateway = None
         
         if 'metric' in conf:
             idx = conf.index('metric')
-            metric = conf[idx + 1]
+            try:
+                metric = int(conf[idx + 1])
+            except (ValueError, IndexError):
+                print(f'Неправильная метрика в строке route {" ".join(conf)}')
             
         if 'vpn_gateway' in conf:
             gateway = 'vpn_gateway'
@@ -94,17 +211,118 @@ class RouteConfig:
         if 'net_gateway' in conf:
             gateway = 'net_gateway'
             
-        self.append_route(ipv4, metric, gateway)
+        return metric, gateway
             
     
+    def iter_routes(self):
+        """Лениво отдаёт маршруты (сеть, длина префикса, метрика, шлюз, семейство).
+
+        Файл читается построчно пачками по STREAM_BATCH строк route,
+        доменные имена каждой пачки разрешаются параллельно.
+        """
+        batch = []
+        for conf in self.iter_confs():
+            batch.append(conf)
+            if len(batch) >= STREAM_BATCH:
+                yield from self.parse_batch(batch)
+                batch = []
+        yield from self.parse_batch(batch)
+
+    def parse_batch(self, confs):
+        is_ip = [self.is_ip(conf[0]) for conf in confs]
+        hostnames = [conf[0] for conf, ip in zip(confs, is_ip) if not ip]
+        self.hostnames.update(hostnames)
+        with self.stats.phase('dns'):
+            self.resolved = self.resolver.resolve(hostnames)
+        self.answers.update(self.resolved)
+        if hostnames:
+            self.stats.count('dns_names', len(self.resolved), result='resolved')
+            self.stats.count('dns_names', len(self.resolver.failed), result='failed')
+        for hostname, error in self.resolver.failed:
+            print(f'[-] Не удалось разрешить {hostname}: {error}')
+        self.resolver.failed.clear()
+
+        # Строки с IPv4-адресами разбираем разом, массивами NumPy
+        parsed = [None] * len(confs)
+        literal = [i for i, conf in enumerate(confs) if len(conf) > 1 and is_ip[i] and ':' not in conf[0]]
+        if len(literal) >= rvector.MIN_VECTOR_SIZE and rvector.available():
+            networks, prefixlens, valid = rvector.parse_columns([confs[i][0] for i in literal],
+                                                                [confs[i][1] for i in literal])
+            for i, network, prefixlen, ok in zip(literal, networks.tolist(), prefixlens.tolist(),
+                                                 valid.tolist()):
+                if ok:
+                    parsed[i] = (network, prefixlen)
+
+        for conf, prefix in zip(confs, parsed):
+            if prefix is None:
+                # Имена и строки с ошибками — обычным путём, он же печатает ошибку
+                yield from self.route_prefixes(conf)
+            else:
+                yield (*prefix, *self.route_options(conf), socket.AF_INET)
+
     def extract_routes(self):
-        if self.config_content != None:
-            for line in self.config_content.splitlines():
-                match = self.route_regex.match(line.strip())
-                if match:
-                    if match.group('route'):
-                        route = match.group('route').split()
-                        self.parse_route(route)
+        for network, prefixlen, metric, gateway, family in self.iter_routes():
+            self.append_prefix(network, prefixlen, metric, gateway, family)
+
+        if self.aggregate:
+            self.optimize_routes()
+
+    def cache_flags(self):
+        return rcache.FLAG_AGGREGATE if self.aggregate else 0
+
+    def load_compiled(self):
+        """Берёт маршруты из route_cache, если конфиг и ответы DNS не менялись"""
+        if not self.route_cache:
+            return False
+        with self.stats.phase('cache_load'):
+            table = rcache.load(self.route_cache, self.config_file, self.dns_cache, self.cache_flags())
+        self.stats.count('route_cache', result='miss' if table is None else 'hit')
+        if table is None:
+            return False
+        self.routes = table
+        self.counter = len(table)
+        return True
+
+    def save_compiled(self):
+        if self.route_cache:
+            with self.stats.phase('cache_save'):
+                rcache.save(self.route_cache, self.config_file, self.routes, self.answers, self.cache_flags(),
+                            self.hostnames)
+
+    def optimize_routes(self):
+        """Убирает дубли и вложенные сети, склеивает соседние префиксы.
+
+        Сети объединяются только внутри группы с одинаковыми семейством,
+        шлюзом и метрикой, так что маршрутизация трафика не меняется.
+        """
+        with self.stats.phase('aggregate'):
+            self.collapse_groups()
+
+    def collapse_groups(self):
+        table = self.routes
+        groups = defaultdict(lambda: ([], []))
+        for i in range(len(table)):
+            networks, prefixlens = groups[table.group_key(i)]
+            networks.append(table.network(i))
+            prefixlens.append(table.prefixlens[i])
+
+        before = len(table)
+        self.routes = rtable.RouteTable()
+        self.counter = 0
+        # Группы идут в порядке первого появления в конфиге
+        for (family, gateway_id, metric), (networks, prefixlens) in groups.items():
+            gateway = table.gateway_names[gateway_id]
+            metric = None if metric == rtable.NO_METRIC else metric
+            if family == socket.AF_INET6:
+                # 128 бит не влезают в uint64 NumPy, IPv6 склеиваем на чистом Python
+                collapsed = rtable.collapse(zip(networks, prefixlens), bits=128)
+            else:
+                collapsed = rvector.collapse(networks, prefixlens)
+            for network, prefixlen in collapsed:
+                self.append_prefix(network, prefixlen, metric, gateway, family)
+
+        if before != len(self.routes):
+            print(f'[+] Оптимизация маршрутов: {before} -> {len(self.routes)}')
 
     def print_usage(self):
         print("Использование: python convert_openvpn_routes.py <input.conf> <output.json>")
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import json
+import socket
+
+# Протокол управления демоном: одна JSON-строка запроса, одна JSON-строка ответа.
+# Модуль нарочно импортирует только json и socket — его грузит тонкий клиент.
+
+SOCKET_PATH = "/run/route-manager.sock"
+COMMANDS = ("up", "down", "reload", "import", "status", "stats")
+TIMEOUT = 600
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False).encode() + b'\n'
+
+
+def decode(line: bytes) -> dict:
+    return json.loads(line.decode())
+
+
+def request(command: str, interface: str = None, socket_path: str = SOCKET_PATH,
+            timeout: float = TIMEOUT) -> dict:
+    """Отправляет команду демону и ждёт ответа"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(encode({'command': command, 'interface': interface}))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("Демон закрыл соединение без ответа")
+    return decode(line)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import random
+import socket
+import struct
+
+# Минимальный DNS-клиент: нужен ради TTL, которого нет у getaddrinfo
+
+HOSTS_FILE = "/etc/hosts"
+RESOLV_CONF = "/etc/resolv.conf"
+DNS_PORT = 53
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_AAAA = 28
+
+RCODE_NXDOMAIN = 3
+
+FLAG_TC = 0x0200
+
+class DnsError(Exception):
+    """Ответ DNS-сервера не получен или не разобран"""
+
+    def __init__ (self, message, rcode=None):
+        super().__init__(message)
+        self.rcode = rcode
+
+
+def nameservers(resolv_conf: str = RESOLV_CONF):
+    """Адреса DNS-серверов из resolv.conf"""
+    servers = []
+    try:
+        with open(resolv_conf, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == 'nameserver':
+                    servers.append(parts[1])
+    except OSError:
+        pass
+    return servers
+
+
+def hosts(hosts_file: str = HOSTS_FILE) -> dict:
+    """Имена из /etc/hosts: {имя в нижнем регистре: [адреса]}"""
+    names = {}
+    try:
+        with open(hosts_file, 'r') as f:
+            for line in f:
+                parts = line.split('#', 1)[0].split()
+                for name in parts[1:]:
+                    addrs = names.setdefault(name.lower(), [])
+                    if parts[0] not in addrs:
+                        addrs.append(parts[0])
+    except OSError:
+        pass
+    return names
+
+
+def encode_name(name: str) -> bytes:
+    labels = name.rstrip('.').encode('idna').split(b'.')
+    return b''.join(struct.pack('B', len(label)) + label for label in labels) + b'\0'
+
+
+def decode_name(data: bytes, offset: int):
+    """Читает имя с учётом сжатия, возвращает (имя, смещение за ним)"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from('!H', data, offset)[0] & 0x3FFF
+            jumps += 1
+            if jumps > 64:
+                raise DnsError("Зацикленное сжатие имени")
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    return '.'.join(labels).lower(), (end if end is not None else offset)
+
+
+def build_query(qid: int, name: str, qtype: int = TYPE_A) -> bytes:
+    header = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)
+    return header + encode_name(name) + struct.pack('!HH', qtype, 1)
+
+
+def parse_question(data: bytes):
+    """Первый вопрос пакета: (имя, тип, класс) или None, если вопросов нет"""
+    if len(data) < 12:
+        raise DnsError("Слишком короткий пакет")
+    if not struct.unpack_from('!H', data, 4)[0]:
+        return None
+    qname, offset = decode_name(data, 12)
+    return (qname, *struct.unpack_from('!HH', data, offset))
+
+
+def parse_response(data: bytes):
+    """Разбирает ответ: (id, flags, [(имя, тип, ttl, данные)], вопрос)"""
+    if len(data) < 12:
+        raise DnsError("Слишком короткий ответ")
+    qid, flags, qdcount, ancount, _, _ = struct.unpack_from('!HHHHHH', data, 0)
+    offset = 12
+    question = None
+    for _ in range(qdcount):
+        qname, offset = decode_name(data, offset)
+        qtype, _ = struct.unpack_from('!HH', data, offset)
+        offset += 4
+        question = (qname, qtype)
+
+    answers = []
+    for _ in range(ancount):
+        name, offset = decode_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        if rtype == TYPE_A and rdlength == 4:
+            value = socket.inet_ntoa(rdata)
+        elif rtype == TYPE_AAAA and rdlength == 16:
+            value = socket.inet_ntop(socket.AF_INET6, rdata)
+        elif rtype == TYPE_CNAME:
+            value = decode_name(data, offset)[0]
+        else:
+            value = rdata
+        answers.append((name, rtype, ttl, value))
+        offset += rdlength
+    return qid, flags, answers, question
+
+
+def _exchange_udp(server, packet, timeout):
+    with socket.socket(socket.AF_INET6 if ':' in server else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(packet, (server, DNS_PORT))
+        return sock.recv(65535)
+
+
+def _exchange_tcp(server, packet, timeout):
+    with socket.create_connection((server, DNS_PORT), timeout=timeout) as sock:
+        sock.sendall(struct.pack('!H', len(packet)) + packet)
+        length = struct.unpack('!H', _recv_exact(sock, 2))[0]
+        return _recv_exact(sock, length)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise DnsError("Сервер закрыл соединение")
+        data += chunk
+    return data
+
+
+def query(name: str, qtype: int = TYPE_A, servers=None, timeout: float = 2.0):
+    """Спрашивает серверы по очереди, возвращает (адреса, минимальный TTL)"""
+    servers = servers if servers is not None else nameservers()
+    if not servers:
+        raise DnsError("Нет DNS-серверов")
+
+    last_error = None
+    for server in servers:
+        qid = random.randint(0, 0xFFFF)
+        packet = build_query(qid, name, qtype)
+        try:
+            data = _exchange_udp(server, packet, timeout)
+            rid, flags, answers, _ = parse_response(data)
+            if flags & FLAG_TC:
+                rid, flags, answers, _ = parse_response(_exchange_tcp(server, packet, timeout))
+        except (OSError, DnsError, struct.error, IndexError) as e:
+            last_error = e
+            continue
+        if rid != qid:
+            last_error = DnsError(f"Чужой ответ от {server}")
+            continue
+        rcode = flags & 0x000F
+        if rcode == RCODE_NXDOMAIN:
+            raise DnsError(f"{name}: нет такого имени", rcode)
+        if rcode != 0:
+            last_error = DnsError(f"{name}: rcode {rcode} от {server}", rcode)
+            continue
+        records = [(ttl, value) for _, rtype, ttl, value in answers if rtype == qtype]
+        addrs = list(dict.fromkeys(value for _, value in records))
+        ttl = min((ttl for ttl, _ in records), default=0)
+        return addrs, ttl
+    raise DnsError(f"{name}: нет ответа ({last_error})")
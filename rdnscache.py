@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+
+DNS_CACHE_FILE = "./dns_cache.json"
+# Сколько имён держим в кэше, самые давно не использованные вытесняются
+DNS_CACHE_SIZE = 4096
+# Сколько секунд после истечения TTL запись ещё годится как запасная
+DNS_CACHE_MAX_STALE = 7 * 24 * 3600
+
+class DnsCache:
+    """Кэш разрешённых имён на диске: {имя: адреса, срок годности, последнее использование}"""
+
+    def __init__ (self, cache_file: str = DNS_CACHE_FILE, max_entries: int = DNS_CACHE_SIZE,
+                  max_stale: float = DNS_CACHE_MAX_STALE):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.max_stale = max_stale
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError) as e:
+            print(f'[-] Кэш DNS {self.cache_file} не прочитан: {e}')
+            self.entries = {}
+
+    def get(self, hostname: str):
+        """Возвращает (адреса, свежая ли запись) или None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(hostname)
+            if entry is None or now - entry['expires'] > self.max_stale:
+                return None
+            entry['used'] = now
+            return entry['addrs'], now < entry['expires']
+
+    def put(self, hostname: str, addrs: list, ttl: float):
+        now = time.time()
+        with self.lock:
+            self.entries[hostname] = {'addrs': addrs, 'expires': now + ttl, 'used': now}
+
+    def evict(self):
+        """Выкидывает протухшие записи и самые старые сверх max_entries"""
+        now = time.time()
+        with self.lock:
+            entries = {name: entry for name, entry in self.entries.items()
+                       if now - entry['expires'] <= self.max_stale}
+            if len(entries) > self.max_entries:
+                keep = sorted(entries, key=lambda name: entries[name]['used'], reverse=True)
+                entries = {name: entries[name] for name in keep[:self.max_entries]}
+            self.entries = entries
+
+    def save(self):
+        """Пишет кэш атомарно: во временный файл и rename"""
+        self.evict()
+        # Своё имя у каждого потока: кэш могут сохранять несколько туннелей сразу
+        tmp_file = f'{self.cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with self.lock:
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.entries, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            print(f'[-] Кэш DNS {self.cache_file} не сохранён: {e}')
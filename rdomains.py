@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+import heapq
+import random
+import selectors
+import socket
+import struct
+import time
+
+import rdns
+import rlpm
+
+# Маршруты по доменам: маленький пересылающий DNS-сервер. Запросы уходят
+# к настоящему DNS, а адреса из ответов на имена из route-domain (и их
+# поддомены) ставятся маршрутами /32 (AAAA — /128) до того, как ответ
+# получит клиент.
+# Маршрут живёт, пока не истечёт TTL последнего ответа с этим адресом.
+# Метка proto у этих маршрутов своя (RouteManager.domain_proto), в файл
+# состояния они не пишутся: up и reload их не видят и не снимают.
+# Сервер только UDP: TCP не слушается, и ответ с флагом TC клиент
+# повторить по TCP не сможет. Для маршрутов хватает и усечённого ответа.
+
+# TTL короче этого не берём: браузеры держат адреса дольше, чем велит DNS
+DOMAIN_MIN_TTL = 300
+# Сколько ждём ответа вышестоящего сервера
+UPSTREAM_TIMEOUT = 5.0
+LISTEN = '127.0.0.1:53'
+
+def parse_address(value: str, port: int = rdns.DNS_PORT):
+    """'адрес[:порт]' -> (адрес, порт)"""
+    host, sep, text = value.rpartition(':')
+    if not sep or ':' in host:
+        return value, port
+    return host, int(text)
+
+
+class DomainMatcher:
+    """Домен и все его поддомены -> (метрика, шлюз).
+
+    Поиск — по суффиксам имени, от самого длинного: число проверок
+    равно числу меток имени, а не числу доменов.
+    """
+
+    def __init__ (self, domains):
+        self.domains = {domain: (metric, gateway) for domain, metric, gateway in domains}
+
+    def __len__ (self):
+        return len(self.domains)
+
+    def match(self, name: str):
+        labels = name.rstrip('.').lower().split('.')
+        for i in range(len(labels)):
+            found = self.domains.get('.'.join(labels[i:]))
+            if found is not None:
+                return found
+        return None
+
+
+class ExpiryHeap:
+    """Сроки жизни адресов: продление — O(log n), истёкшие — по одному pop.
+
+    Устаревшие записи из кучи не удаляются сразу: при pop сверяемся со
+    словарём сроков. Когда мусора становится больше живых записей, куча
+    пересобирается.
+    """
+
+    def __init__ (self):
+        self.expires = {}
+        self.heap = []
+
+    def __len__ (self):
+        return len(self.expires)
+
+    def __contains__ (self, key):
+        return key in self.expires
+
+    def touch(self, key, expires: float) -> bool:
+        """Продлевает ключ до expires; True — ключ новый"""
+        new = key not in self.expires
+        if new or expires > self.expires[key]:
+            self.expires[key] = expires
+            heapq.heappush(self.heap, (expires, key))
+            if len(self.heap) > 2 * len(self.expires) + 1024:
+                self.heap = [(when, key) for key, when in self.expires.items()]
+                heapq.heapify(self.heap)
+        return new
+
+    def next_expiry(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now: float):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            when, key = heapq.heappop(self.heap)
+            if self.expires.get(key) == when:
+                del self.expires[key]
+                expired.append(key)
+        return expired
+
+
+class DomainRouter:
+    """Пересылает DNS-запросы и ставит маршруты по ответам для доменов из конфига"""
+
+    def __init__ (self, manager, domains, listen: str = LISTEN, upstream=None,
+                  min_ttl: int = DOMAIN_MIN_TTL, timeout: float = UPSTREAM_TIMEOUT):
+        self.manager = manager
+        self.matcher = DomainMatcher(domains)
+        self.listen = parse_address(listen)
+        # Себя в вышестоящих серверах не держим, иначе запрос зациклится
+        servers = upstream if upstream else rdns.nameservers()
+        self.upstream = [parse_address(server) for server in servers
+                         if parse_address(server) != self.listen]
+        if not self.upstream:
+            raise ValueError("Нет вышестоящего DNS-сервера")
+        self.min_ttl = min_ttl
+        self.timeout = timeout
+        # Адреса, которые уже покрыты маршрутами из конфига, не дублируем
+        self.covered = rlpm.PrefixIndex(manager.routes)
+        self.routes = ExpiryHeap()
+        # Наш id запроса -> (клиент, его id, вопрос, срок ответа, запрос, попытки)
+        self.pending = {}
+        # Номер текущего вышестоящего сервера: при таймауте или ICMP — следующий
+        self.current = 0
+        self.selector = None
+
+    def open(self):
+        family = socket.AF_INET6 if ':' in self.listen[0] else socket.AF_INET
+        self.server = socket.socket(family, socket.SOCK_DGRAM)
+        self.server.bind(self.listen)
+        self.connect()
+
+    def connect(self):
+        server, port = self.upstream[self.current]
+        self.client = socket.socket(socket.AF_INET6 if ':' in server else socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.connect((server, port))
+        # После переключения в выборке select может остаться старый сокет
+        self.client.setblocking(False)
+        if self.selector is not None:
+            self.selector.register(self.client, selectors.EVENT_READ, 'answer')
+
+    def failover(self, reason):
+        """Переходит к следующему вышестоящему серверу и отправляет ему запросы в полёте.
+
+        Запрос, который обошёл все серверы, бросается: клиент повторит его сам.
+        """
+        server = self.upstream[self.current][0]
+        self.current = (self.current + 1) % len(self.upstream)
+        print(f"[-] DNS {server}: {reason}, дальше {self.upstream[self.current][0]}")
+        self.manager.stats.count('domain_failovers')
+        if self.selector is not None:
+            self.selector.unregister(self.client)
+        self.client.close()
+        self.connect()
+        deadline = time.monotonic() + self.timeout
+        for qid, (peer, client_id, question, _, query, tries) in list(self.pending.items()):
+            if tries >= len(self.upstream):
+                del self.pending[qid]
+                continue
+            self.pending[qid] = (peer, client_id, question, deadline, query, tries + 1)
+            try:
+                self.client.send(query)
+            except OSError as e:
+                # Не дошло и до этого сервера: дальше — по таймауту
+                print(f"[-] DNS: {e}")
+                break
+
+    def close(self):
+        self.server.close()
+        self.client.close()
+
+    def forward_query(self, data: bytes, peer):
+        try:
+            question = rdns.parse_question(data)
+        except (rdns.DnsError, struct.error, IndexError) as e:
+            print(f"[-] Не разобран запрос DNS: {e}")
+            return
+        # id случайный: угадать его, чтобы подсунуть свой ответ (и маршрут), сложнее
+        qid = random.getrandbits(16)
+        while qid in self.pending:
+            qid = random.getrandbits(16)
+        query = struct.pack('!H', qid) + data[2:]
+        self.pending[qid] = (peer, data[:2], question, time.monotonic() + self.timeout, query, 1)
+        self.client.send(query)
+        self.manager.stats.count('domain_queries')
+
+    def forward_answer(self, data: bytes):
+        if len(data) < 12:
+            return
+        qid = struct.unpack_from('!H', data, 0)[0]
+        request = self.pending.get(qid)
+        if request is None:
+            return
+        peer, client_id, question = request[:3]
+        try:
+            answered = rdns.parse_question(data)
+        except (rdns.DnsError, struct.error, IndexError) as e:
+            answered = e
+        if answered != question:
+            # Ответ не на наш вопрос: подделка или запоздавший ответ, ждём настоящий
+            print(f"[-] Ответ DNS с id {qid} не на заданный вопрос")
+            return
+        del self.pending[qid]
+        try:
+            self.learn(data)
+        except (rdns.DnsError, struct.error, IndexError, UnicodeError) as e:
+            print(f"[-] Не разобран ответ DNS: {e}")
+        # Ответ уходит клиенту только после того, как маршрут встал
+        self.server.sendto(client_id + data[2:], peer)
+
+    def learn(self, data: bytes):
+        """Ставит /32 и /128 на адреса из ответа, если вопрос — про наш домен"""
+        _, _, answers, question = rdns.parse_response(data)
+        if question is None or question[1] not in (rdns.TYPE_A, rdns.TYPE_AAAA):
+            return
+        found = self.matcher.match(question[0])
+        if found is None:
+            return
+        metric, gateway = found
+        now = time.monotonic()
+        routes = []
+        prefixlen = 32 if question[1] == rdns.TYPE_A else 128
+        for _, rtype, ttl, address in answers:
+            if rtype != question[1]:
+                continue
+            covered = self.covered.lookup(address)
+            if covered is not None and covered['gateway'] == gateway:
+                continue
+            route = {'network': f'{address}/{prefixlen}', 'gateway': gateway, 'metric': metric}
+            self.routes.touch((route['network'], metric, gateway), now + max(ttl, self.min_ttl))
+            routes.append(route)
+        if routes:
+            # add на каждый ответ, а не только на новый адрес: маршрут мог снять
+            # кто-то другой, а уже стоящий просто вернёт EEXIST
+            result = self.manager.bulk_route("add", routes, proto=self.manager.domain_proto, report=False)
+            self.manager.stats.count('domain_routes', len(result.ok), result='added')
+            if result.failed:
+                result.report(self.manager.iface_name)
+            if result.ok:
+                print(f"[+] {question[0]}: +{len(result.ok)} маршрутов, всего {len(self.routes)}")
+
+    def expire(self):
+        now = time.monotonic()
+        timed_out = [qid for qid, request in self.pending.items() if request[3] <= now]
+        if timed_out and len(self.upstream) > 1:
+            self.failover("нет ответа")
+        else:
+            for qid in timed_out:
+                del self.pending[qid]
+        expired = self.routes.pop_expired(now)
+        if expired:
+            routes = [{'network': network, 'gateway': gateway, 'metric': metric}
+                      for network, metric, gateway in expired]
+            result = self.manager.bulk_route("del", routes, proto=self.manager.domain_proto)
+            self.manager.stats.count('domain_routes', len(result.ok) + len(result.skipped), result='expired')
+
+    def serve(self):
+        """Работает до Ctrl+C, потом снимает поставленные маршруты"""
+        self.open()
+        selector = self.selector = selectors.DefaultSelector()
+        selector.register(self.server, selectors.EVENT_READ, 'query')
+        selector.register(self.client, selectors.EVENT_READ, 'answer')
+        print(f"[+] DNS для {len(self.matcher)} доменов на {self.listen[0]}:{self.listen[1]}, "
+              f"вышестоящий {self.upstream[0][0]}")
+        try:
+            while True:
+                next_expiry = self.routes.next_expiry()
+                timeout = 1.0 if next_expiry is None else min(1.0, max(0.0, next_expiry - time.monotonic()))
+                for key, _ in selector.select(timeout):
+                    try:
+                        if key.data == 'query':
+                            self.forward_query(*self.server.recvfrom(65535))
+                        else:
+                            self.forward_answer(self.client.recv(65535))
+                    except BlockingIOError:
+                        pass
+                    except OSError as e:
+                        if key.data == 'answer' and len(self.upstream) > 1:
+                            # ICMP unreachable от вышестоящего сервера
+                            self.failover(e)
+                        else:
+                            print(f"[-] DNS: {e}")
+                self.expire()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            selector.close()
+            self.selector = None
+            self.close()
+            routes = [{'network': network, 'gateway': gateway, 'metric': metric}
+                      for network, metric, gateway in self.routes.expires]
+            if routes:
+                self.manager.bulk_route("del", routes, proto=self.manager.domain_proto)
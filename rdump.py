@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import json
+import socket
+from datetime import datetime
+
+# Снимок таблицы маршрутизации через netlink вместо разбора `ip route show`
+
+RT_TABLE_MAIN = 254
+
+PROTOCOLS = {1: 'redirect', 2: 'kernel', 3: 'boot', 4: 'static', 16: 'dhcp'}
+SCOPES = {200: 'site', 253: 'link', 254: 'host', 255: 'nowhere'}
+
+def open_iproute():
+    """IPRoute со строгой проверкой: фильтры дампа применяет само ядро"""
+    import rpyroute
+    return rpyroute.IPRoute(strict_check=True)
+
+
+def dump(ipr, oif=None, table=RT_TABLE_MAIN, family=socket.AF_INET, **filters):
+    """Сообщения RTM_NEWROUTE, отфильтрованные ядром по oif и таблице"""
+    if oif is not None:
+        filters['oif'] = oif
+    if table is not None:
+        filters['table'] = table
+    yield from ipr.route('dump', family=family, **filters)
+
+
+def route_entry(msg, links: dict) -> dict:
+    """Маршрут в формате read.py: destination, via, dev, metric, raw"""
+    dst = msg.get_attr('RTA_DST')
+    prefixlen = msg['dst_len']
+    if dst is None:
+        destination = 'default'
+    elif prefixlen == (128 if msg['family'] == socket.AF_INET6 else 32):
+        destination = dst
+    else:
+        destination = f'{dst}/{prefixlen}'
+
+    via = msg.get_attr('RTA_GATEWAY')
+    dev = links.get(msg.get_attr('RTA_OIF'))
+    metric = msg.get_attr('RTA_PRIORITY')
+    src = msg.get_attr('RTA_PREFSRC')
+
+    # raw собираем так же, как его печатает `ip route show`
+    raw = [destination]
+    if via:
+        raw += ['via', via]
+    if dev:
+        raw += ['dev', dev]
+    # proto boot ip не печатает, это значение по умолчанию
+    if msg['proto'] != 3:
+        raw += ['proto', PROTOCOLS.get(msg['proto'], str(msg['proto']))]
+    if msg['scope'] in SCOPES:
+        raw += ['scope', SCOPES[msg['scope']]]
+    if src:
+        raw += ['src', src]
+    if metric is not None:
+        raw += ['metric', str(metric)]
+
+    return {
+        'destination': destination,
+        'via': via,
+        'dev': dev,
+        'metric': metric,
+        'raw': ' '.join(raw),
+    }
+
+
+def dump_routes(interface: str = None, table: int = RT_TABLE_MAIN, family=socket.AF_INET, ipr=None):
+    """Генератор маршрутов в формате read.py, один netlink-дамп без fork/exec"""
+    own = ipr is None
+    if own:
+        ipr = open_iproute()
+    try:
+        links = {link['index']: link.get_attr('IFLA_IFNAME') for link in ipr.get_links()}
+        oif = None
+        if interface is not None:
+            oif = next((index for index, name in links.items() if name == interface), None)
+            if oif is None:
+                return
+        for msg in dump(ipr, oif=oif, table=table, family=family):
+            yield route_entry(msg, links)
+    finally:
+        if own:
+            ipr.close()
+
+
+def write_routes(f, routes) -> int:
+    """Пишет маршруты в JSON по мере получения, не собирая их в список"""
+    f.write('{\n  "timestamp": ' + json.dumps(datetime.now().isoformat()) + ',\n  "routes": [')
+    total = 0
+    for route in routes:
+        f.write(',\n    ' if total else '\n    ')
+        f.write(json.dumps(route))
+        total += 1
+    f.write('\n  ],\n  "total_routes": ' + str(total) + '\n}\n')
+    return total
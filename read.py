@@ -1,9 +1,9 @@
-import subprocess
-import json
 from datetime import datetime
 import os
 from pathlib import Path
 
+import rdump
+
 class WriteRoutes:
 
     def __init__(self, output_dir='out', interface=None):
@@ -25,41 +25,20 @@ class WriteRoutes:
         :param output_file: Путь к выходному файлу
         :param interface: Фильтр по интерфейсу (например, 'tun0')
         """
-        # Получаем маршруты через ip route
-        result = subprocess.run(['ip', 'route', 'show'], capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"Ошибка: {result.stderr}")
+        # Получаем маршруты одним netlink-дампом, ядро само фильтрует по интерфейсу.
+        # Пишем во временный файл: ошибка дампа не оставит обрезанный JSON
+        tmp_file = f'{self.route_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                total = rdump.write_routes(f, rdump.dump_routes(interface=self.interface))
+            os.replace(tmp_file, self.route_file)
+        except Exception as e:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            print(f"Ошибка: {e}")
             return
 
-        # Парсим вывод
-        routes = []
-        for line in result.stdout.splitlines():
-            if self.interface and f"dev {self.interface}" not in line:
-                continue
-                
-            parts = line.split()
-            route = {
-                'destination': 'default' if 'default' in parts else parts[0],
-                'via': parts[parts.index('via') + 1] if 'via' in parts else None,
-                'dev': parts[parts.index('dev') + 1] if 'dev' in parts else None,
-                'metric': int(parts[parts.index('metric') + 1]) if 'metric' in parts else None,
-                'raw': line
-            }
-            routes.append(route)
-
-        # Добавляем метаданные
-        data = {
-            'timestamp': datetime.now().isoformat(),
-            'total_routes': len(routes),
-            'routes': routes
-        }
-
-        # Сохраняем в файл
-        with open(self.route_file, 'w') as f:
-            json.dump(data, f, indent=2)
-        
-        print(f"Сохранено {len(routes)} маршрутов в {self.route_file}")
+        print(f"Сохранено {total} маршрутов в {self.route_file}")
 
 
 # Пример использования
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import csv
+import json
+import os
+import re
+import socket
+
+import rtable
+import rvector
+
+# Импорт больших списков префиксов из готовых источников. В конфиге:
+#
+#   route-import cidr chatgpt.txt          (IPv4 и IPv6 вперемешку)
+#   route-import csv  blocks.csv column=network net_gateway
+#   route-import rir  delegated-ripencc-latest cc=RU,BY net_gateway metric 10
+#   route-import asn  table.txt asn=13335,15169
+#
+# Путь считается от каталога конфига. Что из источников уже стоит,
+# хранится в файле состояния <файл состояния>.feeds, и import передаёт
+# установщику только разницу.
+
+FORMATS = ('cidr', 'csv', 'rir', 'asn')
+
+ASN_REGEX = re.compile(r'^(?:AS)?(\d+)$', re.IGNORECASE)
+
+class Feed:
+    """Источник из строки route-import"""
+
+    def __init__ (self, kind: str, path: str, options: dict = None, metric=None, gateway='vpn_gateway'):
+        if kind not in FORMATS:
+            raise ValueError(f"Неизвестный формат {kind}, ожидается {', '.join(FORMATS)}")
+        self.kind = kind
+        self.path = path
+        self.options = options or {}
+        self.metric = metric
+        self.gateway = gateway
+
+    @property
+    def key(self) -> str:
+        options = ','.join(f'{name}={value}' for name, value in sorted(self.options.items()))
+        return f'{self.kind}:{self.path}:{options}'
+
+    def signature(self):
+        """Что должно поменяться, чтобы источник перечитывался"""
+        stat = os.stat(self.path)
+        return [stat.st_mtime_ns, stat.st_size, self.metric, self.gateway]
+
+    def prefixes(self) -> list:
+        """Префиксы источника (сеть числом, длина, семейство), уже склеенные"""
+        reader = READERS[self.kind]
+        families = {socket.AF_INET: ([], []), socket.AF_INET6: ([], [])}
+        with open(self.path, 'r', newline='', errors='replace') as f:
+            for network, prefixlen, family in reader(f, self.options):
+                networks, prefixlens = families[family]
+                networks.append(network)
+                prefixlens.append(prefixlen)
+        prefixes = []
+        networks, prefixlens = families[socket.AF_INET]
+        if networks:
+            prefixes += [(network, prefixlen, socket.AF_INET)
+                         for network, prefixlen in rvector.collapse(networks, prefixlens)]
+        networks, prefixlens = families[socket.AF_INET6]
+        if networks:
+            prefixes += [(network, prefixlen, socket.AF_INET6)
+                         for network, prefixlen in rtable.collapse(zip(networks, prefixlens), bits=128)]
+        return prefixes
+
+
+def parse_directive(words, base_dir: str = '.', route_options=None) -> Feed:
+    """Слова строки route-import -> Feed. route_options — как в RouteConfig"""
+    if len(words) < 2:
+        raise ValueError("route-import: нужны формат и файл")
+    kind, path = words[0].lower(), words[1]
+    options = dict(word.split('=', 1) for word in words[2:] if '=' in word)
+    metric, gateway = route_options(words) if route_options else (None, None)
+    return Feed(kind, os.path.join(base_dir, path), options, metric, gateway or 'vpn_gateway')
+
+
+def parse_cidr(text: str):
+    """'1.2.3.0/24', '2001:db8::/32' или адрес -> (сеть, длина, семейство);
+    биты хоста обнуляются"""
+    address, _, length = text.strip().partition('/')
+    family = rtable.address_family(address)
+    if family is None:
+        return None
+    bits = rtable.family_bits(family)
+    if length and not (length.isdigit() and int(length) <= bits):
+        return None
+    prefixlen = int(length) if length else bits
+    if family == socket.AF_INET6:
+        network = rtable.ip6_to_int(address)
+    else:
+        network = rtable.ip_to_int(address)
+    return network & rtable.prefixlen_to_mask(prefixlen, bits), prefixlen, family
+
+
+def range_prefixes(start: int, count: int):
+    """Диапазон адресов в минимальный набор префиксов"""
+    end = start + count
+    while start < end:
+        # Самый большой блок, выровненный по start и не выходящий за end
+        size = start & -start if start else 1 << 32
+        while start + size > end:
+            size >>= 1
+        yield start, 32 - size.bit_length() + 1
+        start += size
+
+
+def read_cidr(f, options):
+    """Префикс в начале строки, # — комментарий"""
+    for line in f:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            prefix = parse_cidr(line.split()[0])
+            if prefix is not None:
+                yield prefix
+
+
+def read_csv(f, options):
+    """CSV с префиксом в колонке column (имя из заголовка или номер, по умолчанию 0)"""
+    column = options.get('column', '0')
+    rows = csv.reader(f)
+    index = int(column) if column.isdigit() else None
+    for row in rows:
+        if index is None:
+            # Первая строка — заголовок
+            if column not in row:
+                raise ValueError(f"В заголовке CSV нет колонки {column}")
+            index = row.index(column)
+            continue
+        if len(row) > index:
+            prefix = parse_cidr(row[index])
+            if prefix is not None:
+                yield prefix
+
+
+def read_rir(f, options):
+    """Статистика RIR (delegated-*-latest): registry|cc|ipv4|начало|количество|дата|статус.
+
+    У записей ipv6 вместо количества адресов — длина префикса.
+    """
+    countries = {cc.upper() for cc in options['cc'].split(',')} if 'cc' in options else None
+    for line in f:
+        if line.startswith('#'):
+            continue
+        fields = line.strip().split('|')
+        if len(fields) < 7 or fields[2] not in ('ipv4', 'ipv6') or fields[1] == '*':
+            continue
+        if countries is not None and fields[1].upper() not in countries:
+            continue
+        if fields[2] == 'ipv6':
+            prefix = parse_cidr(f'{fields[3]}/{fields[4]}')
+            if prefix is not None:
+                yield prefix
+            continue
+        try:
+            start = rtable.ip_to_int(fields[3])
+            count = int(fields[4])
+        except (OSError, ValueError):
+            continue
+        for network, prefixlen in range_prefixes(start, count):
+            yield network, prefixlen, socket.AF_INET
+
+
+def read_asn(f, options):
+    """Дамп префиксов по ASN: в строке префикс и номер AS в любом порядке
+    ('1.0.0.0/24 13335', 'AS13335 1.0.0.0/24', CSV через запятую)"""
+    wanted = {ASN_REGEX.match(asn).group(1) for asn in options['asn'].split(',')} if 'asn' in options else None
+    for line in f:
+        if line.startswith('#'):
+            continue
+        prefix = asn = None
+        for word in re.split(r'[\s,|;]+', line.strip()):
+            if prefix is None and '/' in word:
+                prefix = parse_cidr(word)
+            elif asn is None:
+                match = ASN_REGEX.match(word)
+                if match:
+                    asn = match.group(1)
+        if prefix is None:
+            continue
+        if wanted is None or asn in wanted:
+            yield prefix
+
+
+READERS = {
+    'cidr': read_cidr,
+    'csv': read_csv,
+    'rir': read_rir,
+    'asn': read_asn,
+}
+
+
+class FeedState:
+    """Что из источников уже поставлено: ключ источника -> подпись и префиксы"""
+
+    def __init__ (self, state_file: str):
+        self.state_file = state_file
+        self.feeds = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.feeds = json.load(f)
+
+    def routes(self, feeds: dict) -> dict:
+        """(сеть, метрика, шлюз) -> маршрут, объединение всех источников"""
+        routes = {}
+        for entry in feeds.values():
+            _, _, metric, gateway = entry['signature']
+            for network in entry['prefixes']:
+                routes[(network, metric, gateway)] = {'network': network, 'gateway': gateway, 'metric': metric}
+        return routes
+
+    def refresh(self, feeds, full: bool = False):
+        """Перечитывает изменившиеся источники, возвращает (добавить, удалить).
+
+        Разница считается по объединению источников: префикс, который
+        пропал из одного, но есть в другом, не снимается. full — считать,
+        что раньше ничего не стояло (после down или в новой таблице).
+        """
+        old = {} if full else self.feeds
+        new = {}
+        for feed in feeds:
+            try:
+                signature = feed.signature()
+            except OSError as e:
+                print(f"[-] Источник {feed.path} недоступен: {e}")
+                # Пока файла нет, оставляем то, что стояло
+                if feed.key in old:
+                    new[feed.key] = old[feed.key]
+                continue
+            entry = self.feeds.get(feed.key)
+            if entry is not None and entry['signature'] == signature:
+                new[feed.key] = entry
+                continue
+            prefixes = feed.prefixes()
+            print(f"[+] {feed.kind} {feed.path}: {len(prefixes)} префиксов")
+            new[feed.key] = {'signature': signature,
+                             'prefixes': [rtable.format_prefix(*prefix) for prefix in prefixes]}
+
+        before = self.routes(old)
+        after = self.routes(new)
+        self.feeds = new
+        to_add = [route for key, route in after.items() if key not in before]
+        to_delete = [route for key, route in before.items() if key not in after]
+        return to_add, to_delete
+
+    def discard(self, routes):
+        """Убирает из состояния маршруты, которые не встали: import попробует снова"""
+        failed = {(route['network'], route['metric'], route['gateway']) for route in routes}
+        for entry in self.feeds.values():
+            _, _, metric, gateway = entry['signature']
+            kept = [network for network in entry['prefixes'] if (network, metric, gateway) not in failed]
+            if len(kept) != len(entry['prefixes']):
+                # Подпись сбрасываем, чтобы источник перечитался целиком
+                entry['prefixes'] = kept
+                entry['signature'] = [None, None, metric, gateway]
+
+    def save(self):
+        tmp_file = f'{self.state_file}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.feeds, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            print(f'[-] Состояние источников {self.state_file} не сохранено: {e}')
+
+    def clear(self):
+        self.feeds = {}
+        if os.path.exists(self.state_file):
+            os.unlink(self.state_file)
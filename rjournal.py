@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import json
+import os
+
+import rtable
+
+# Состояние «какие маршруты поставили мы»: снимок current_routes.json и
+# журнал операций после него (JSON по строке на маршрут). Запись в журнал
+# идёт по мере прихода ACK, поэтому после падения известно, что успело
+# встать. Снимок переписывается только при сжатии журнала.
+
+# Сколько записей журнала между fsync
+SYNC_BATCH = 256
+# Журнал сжимается в снимок, когда в нём записей больше, чем
+# max(COMPACT_MIN, COMPACT_RATIO * маршрутов в состоянии)
+COMPACT_MIN = 4096
+COMPACT_RATIO = 2
+
+def route_key(route) -> tuple:
+    """Ключ маршрута как у ядра: сеть и метрика (без метрики — 0, у IPv6 — 1024)"""
+    if route['metric'] is None:
+        return route['network'], rtable.default_metric(route['network'])
+    return route['network'], int(route['metric'])
+
+
+def route_record(route) -> list:
+    """Маршрут в снимке: [сеть, шлюз, метрика]"""
+    return [route['network'], route['gateway'], route['metric']]
+
+
+def record_route(record) -> dict:
+    """Маршрут из снимка: [сеть, шлюз, метрика] или словарь прежних версий"""
+    if isinstance(record, dict):
+        return record
+    network, gateway, metric = record
+    return {'network': network, 'gateway': gateway, 'metric': metric}
+
+
+class RouteJournal:
+    """Снимок + журнал с повтором хвоста при загрузке.
+
+    В памяти на маршрут — только ключ (сеть, метрика) и шлюз: при сотнях
+    тысяч маршрутов словари на каждый заняли бы десятки мегабайт.
+    """
+
+    def __init__ (self, snapshot_file: str, sync_batch: int = SYNC_BATCH):
+        self.snapshot_file = snapshot_file
+        self.journal_file = f'{snapshot_file}.journal'
+        self.sync_batch = max(1, sync_batch)
+        # (сеть, метрика) -> шлюз
+        self.routes = {}
+        # Одинаковые шлюзы и метрики хранятся одним объектом
+        self.values = {}
+        self.loaded = False
+        # Сколько записей сейчас в журнале и сколько из них ещё не на диске
+        self.records = 0
+        self.unsynced = 0
+        self.f = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_file) or os.path.exists(self.journal_file)
+
+    def __len__ (self):
+        if not self.loaded:
+            self.load()
+        return len(self.routes)
+
+    def __contains__ (self, route):
+        if not self.loaded:
+            self.load()
+        return route_key(route) in self.routes
+
+    def current(self) -> list:
+        if not self.loaded:
+            self.load()
+        return [{'network': network, 'gateway': gateway, 'metric': metric or None}
+                for (network, metric), gateway in self.routes.items()]
+
+    def put(self, route):
+        network, metric = route_key(route)
+        values = self.values
+        self.routes[(network, values.setdefault(metric, metric))] = values.setdefault(route['gateway'],
+                                                                                   route['gateway'])
+
+    def apply(self, record):
+        if isinstance(record, dict):
+            # Журнал прежних версий
+            if record['op'] == 'del':
+                self.routes.pop((record['network'], record['metric']), None)
+            else:
+                self.put(record['route'])
+        elif record[0] == 'del':
+            self.routes.pop((record[1], record[2]), None)
+        else:
+            self.put(record_route(record[1:]))
+
+    def load(self) -> list:
+        """Читает снимок и повторяет поверх него журнал"""
+        self.close()
+        self.routes = {}
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                for record in json.load(f):
+                    self.put(record_route(record))
+
+        self.records = 0
+        if os.path.exists(self.journal_file):
+            good = 0
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError, IndexError):
+                        # Недописанная при падении строка: дальше журнала нет
+                        break
+                    good += len(line)
+                    self.records += 1
+                torn = good != f.tell()
+            if torn:
+                os.truncate(self.journal_file, good)
+                print(f'[-] Журнал {self.journal_file} обрезан после {self.records} записей')
+        self.loaded = True
+        return self.current()
+
+    def record(self, command: str, route):
+        """Записывает результат операции над маршрутом (вызывается на каждый ACK)"""
+        if not self.loaded:
+            self.load()
+        if command == 'del':
+            record = ['del', *route_key(route)]
+        else:
+            record = [command, *route_record(route)]
+        self.apply(record)
+
+        if self.f is None:
+            self.f = open(self.journal_file, 'a')
+        self.f.write(json.dumps(record) + '\n')
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_batch:
+            self.sync()
+
+    def sync(self):
+        if self.f is not None and self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def commit(self):
+        """Конец команды: хвост журнала на диск, при необходимости — сжатие"""
+        if not self.loaded:
+            # Команда ничего не записала; сжимать незагруженное — потерять состояние
+            self.load()
+        self.sync()
+        # Без снимка current_routes.json не увидят те, кто читает его напрямую
+        if (self.records > max(COMPACT_MIN, COMPACT_RATIO * len(self.routes))
+                or not os.path.exists(self.snapshot_file)):
+            self.compact()
+
+    def reset(self, routes):
+        """Заменяет состояние целиком (например, после переключения таблицы)"""
+        self.routes = {}
+        for route in routes:
+            self.put(route)
+        self.loaded = True
+        self.compact()
+
+    def compact(self):
+        """Пишет состояние в снимок и очищает журнал.
+
+        Если упасть между заменой снимка и очисткой журнала, при загрузке
+        журнал повторится поверх нового снимка — результат тот же, потому
+        что каждая запись задаёт итоговое состояние своего маршрута.
+        """
+        self.sync()
+        if not self.loaded:
+            self.load()
+        tmp_file = f'{self.snapshot_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump([[network, gateway, metric or None] for (network, metric), gateway in self.routes.items()], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self.close()
+        if os.path.exists(self.journal_file):
+            os.truncate(self.journal_file, 0)
+        self.records = 0
+
+    def forget(self):
+        """Перечитать состояние с диска при следующей записи"""
+        self.close()
+        self.loaded = False
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from itertools import chain
+
+import rcache
+import rconfig
+import rdnscache
+import rtable
+
+# Нет маршрута
+NO_ROUTE = -1
+
+class PrefixIndex:
+    """Поиск самого длинного префикса по отсортированным интервалам.
+
+    Вложенные сети раскладываются в непересекающиеся отрезки адресов,
+    у каждого отрезка — номер самого специфичного маршрута RouteTable.
+    Поиск — один bisect по началам отрезков. У IPv4 и IPv6 отрезки свои.
+    """
+
+    def __init__ (self, table):
+        self.table = table
+        self.starts = array('I')
+        self.owners = array('l')
+        # Начала отрезков IPv6 — числа Python: 128 бит в array не влезают
+        self.starts6 = []
+        self.owners6 = array('l')
+        self.build(socket.AF_INET, self.starts, self.owners)
+        self.build(socket.AF_INET6, self.starts6, self.owners6)
+
+    def build(self, family, starts, owners):
+        table = self.table
+        bits = rtable.family_bits(family)
+
+        def emit(start, end, owner):
+            if end <= start:
+                return
+            if owners and owners[-1] == owner:
+                return
+            starts.append(start)
+            owners.append(owner)
+
+        # Широкие сети раньше узких; из одинаковых сверху окажется
+        # маршрут с меньшей метрикой, как его выберет ядро
+        order = sorted((i for i in range(len(table)) if table.families[i] == family),
+                       key=lambda i: (table.network(i), table.prefixlens[i], -max(table.metrics[i], 0)))
+        stack = []
+        pos = 0
+        for i in order:
+            start = table.network(i)
+            end = start + (1 << (bits - table.prefixlens[i]))
+            while stack and stack[-1][0] <= start:
+                stack_end, owner = stack.pop()
+                emit(pos, stack_end, owner)
+                pos = max(pos, stack_end)
+            emit(pos, start, stack[-1][1] if stack else NO_ROUTE)
+            pos = max(pos, start)
+            stack.append((end, i))
+        while stack:
+            stack_end, owner = stack.pop()
+            emit(pos, stack_end, owner)
+            pos = max(pos, stack_end)
+        emit(pos, 1 << bits, NO_ROUTE)
+
+    def lookup_int(self, address: int) -> int:
+        """Номер маршрута для адреса IPv4 числом или NO_ROUTE"""
+        return self.owners[bisect_right(self.starts, address) - 1]
+
+    def lookup_int6(self, address: int) -> int:
+        """То же для адреса IPv6"""
+        return self.owners6[bisect_right(self.starts6, address) - 1]
+
+    def lookup(self, address: str):
+        """Маршрут (rtable.Route) для адреса или None"""
+        if ':' in address:
+            owner = self.lookup_int6(rtable.ip6_to_int(address))
+        else:
+            owner = self.lookup_int(rtable.ip_to_int(address))
+        return None if owner == NO_ROUTE else self.table[owner]
+
+
+def iter_addresses(f):
+    """Адреса из файла: первое слово каждой строки, пустые и # пропускаются"""
+    for line in f:
+        parts = line.split(None, 1)
+        if parts and not parts[0].startswith('#'):
+            yield parts[0]
+
+
+def lookup_all(index, addresses, out, summary=False):
+    """Ищет маршруты для потока адресов, печатает результат или сводку"""
+    unpack = struct.Struct('!I').unpack
+    inet_aton = socket.inet_aton
+    lookup_int = index.lookup_int
+    hits = Counter()
+    total = invalid = 0
+    for address in addresses:
+        total += 1
+        try:
+            if ':' in address:
+                owner = index.lookup_int6(rtable.ip6_to_int(address))
+            else:
+                owner = lookup_int(unpack(inet_aton(address))[0])
+        except OSError:
+            invalid += 1
+            if not summary:
+                out.write(f'{address} invalid\n')
+            continue
+        hits[owner] += 1
+        if not summary:
+            if owner == NO_ROUTE:
+                out.write(f'{address} -\n')
+            else:
+                route = index.table[owner]
+                out.write(f"{address} {route['network']} {route['gateway']}\n")
+
+    if summary:
+        covered = total - invalid - hits[NO_ROUTE]
+        out.write(f'Всего адресов: {total}, покрыто: {covered}, не покрыто: {hits[NO_ROUTE]}, '
+                  f'ошибок: {invalid}\n')
+        for owner, count in hits.most_common():
+            if owner != NO_ROUTE:
+                route = index.table[owner]
+                out.write(f"{count:>10} {route['network']} {route['gateway']}\n")
+    return hits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="route-manager.py lookup",
+        description="Какой маршрут из конфига обработает адрес (самый длинный префикс)")
+    parser.add_argument("--config", required=True, type=str, help="Путь к файлу конфигурации")
+    parser.add_argument("--file", type=str, help="Файл с адресами, по одному в строке ('-' — stdin)")
+    parser.add_argument("--summary", action="store_true", help="Только сводка покрытия по маршрутам")
+    parser.add_argument("--dns-cache", type=str, default=rdnscache.DNS_CACHE_FILE,
+                        help="Файл кэша DNS. Пустая строка — без кэша")
+    parser.add_argument("--route-cache", type=str, default=None,
+                        help="Двоичный кэш разобранного конфига. Пустая строка — без кэша")
+    parser.add_argument("--no-aggregate", dest="aggregate", action="store_false",
+                        help="Искать по маршрутам ровно как в конфиге")
+    parser.add_argument("address", nargs='*', help="Адреса для поиска")
+    args = parser.parse_args(argv)
+
+    if args.route_cache is None:
+        args.route_cache = rcache.cache_path(args.config)
+
+    # Сообщения разбора конфига — в stderr: stdout lookup разбирают скрипты
+    with contextlib.redirect_stdout(sys.stderr), \
+            rconfig.RouteConfig(args.config, dns_cache=args.dns_cache, aggregate=args.aggregate,
+                                route_cache=args.route_cache) as config:
+        index = PrefixIndex(config.routes)
+
+    if args.file:
+        f = sys.stdin if args.file == '-' else open(args.file, 'r')
+        with f:
+            lookup_all(index, chain(args.address, iter_addresses(f)), sys.stdout, args.summary)
+    else:
+        lookup_all(index, args.address, sys.stdout, args.summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+import errno
+import heapq
+import itertools
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+# Пакетная установка маршрутов своим netlink-сокетом, без pyroute2: тело
+# каждого RTM_NEWROUTE/RTM_DELROUTE кодируется один раз, всё окно уходит
+# одним send, а из ответов читаются только seq и errno (nlmsgerr).
+
+# Потолок окна: сколько запросов можно держать «в полёте» на одном сокете
+DEFAULT_WINDOW = 256
+# С какого окна начинать: дальше оно растёт на 1 за круг ACK без перегрузки
+INITIAL_WINDOW = 32
+# ACK дольше этого — запросы стоят в очереди (ядро занято другими демонами
+# или свой же процесс не успевает): окно сужается на четверть
+LATENCY_TARGET = 0.05
+# Буфер приёма сокета, при ENOBUFS удваивается до RCVBUF_MAX
+DEFAULT_RCVBUF = 1 << 20
+RCVBUF_MAX = 1 << 24
+# Сколько ждать хоть какого-то ответа, потом запросы в полёте считаются
+# потерянными и уходят заново
+ACK_TIMEOUT = 1.0
+# Повторы при временных ошибках: попыток сверх первой и начальная пауза (удваивается)
+RETRIES = 5
+RETRY_DELAY = 0.01
+# Временные ошибки: ENOBUFS и ENOMEM — ещё и признак перегрузки
+TRANSIENT = {errno.ENOBUFS, errno.ENOMEM, errno.EBUSY, errno.EAGAIN, errno.EINTR}
+CONGESTION = {errno.ENOBUFS, errno.ENOMEM}
+# SO_RCVBUF ядро обрезает до net.core.rmem_max, SO_RCVBUFFORCE (нужен
+# CAP_NET_ADMIN, как и для самих маршрутов) — нет
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+# Сколько маршрутов держать в очереди из блокирующего источника (run(blocking=True))
+FEED_CHUNK = 256
+# Сколько байт сообщений отправлять одним send (ядро не примет больше sndbuf)
+SEND_BATCH = 1 << 16
+RECV_BUFFER = 1 << 16
+
+# Ответ на запрос потерян: буфер приёма переполнился или ACK не дождались
+LOST = OSError(errno.ETIMEDOUT, 'ответ netlink потерян')
+
+# linux/netlink.h и linux/rtnetlink.h
+NETLINK_ROUTE = 0
+SOL_NETLINK = 270
+# Ошибка без копии запроса: ответы короче, буфер приёма переполняется позже
+NETLINK_CAP_ACK = 10
+# Дамп фильтрует само ядро: по таблице, метке и RTA_OIF
+NETLINK_GET_STRICT_CHK = 12
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x001
+NLM_F_ACK = 0x004
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+RT_TABLE_COMPAT = 252
+RT_TABLE_MAIN = 254
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNSPEC = 0
+RTN_UNICAST = 1
+RTPROT_BOOT = 3
+
+NLMSGHDR = struct.Struct('=IHHII')
+RTMSG = struct.Struct('=BBBBBBBBI')
+RTATTR = struct.Struct('=HH')
+RTATTR_U32 = struct.Struct('=HHI')
+NLMSGERR = struct.Struct('=i')
+
+# Тип сообщения и флаги на команду, как у ip route add/replace/del
+MESSAGES = {
+    'add': (RTM_NEWROUTE, NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL),
+    'replace': (RTM_NEWROUTE, NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE),
+    'del': (RTM_DELROUTE, NLM_F_REQUEST | NLM_F_ACK),
+}
+U32_ATTRS = (('oif', RTA_OIF), ('priority', RTA_PRIORITY), ('table', RTA_TABLE))
+
+def error_code(error) -> int:
+    """errno из NetlinkError (code) или OSError (errno)"""
+    code = getattr(error, 'code', None)
+    return code if code is not None else getattr(error, 'errno', None)
+
+
+def encode_route(command: str, request: dict) -> bytes:
+    """Тело RTM_NEWROUTE/RTM_DELROUTE (rtmsg и атрибуты) по аргументам IPRoute.route.
+
+    Понимает dst, family, gateway, oif, priority, table и proto — всё, что
+    даёт RouteManager.route_request.
+    """
+    dst, _, prefixlen = request['dst'].partition('/')
+    family = request.get('family') or (socket.AF_INET6 if ':' in dst else socket.AF_INET)
+    if prefixlen:
+        prefixlen = int(prefixlen)
+    else:
+        prefixlen = 128 if family == socket.AF_INET6 else 32
+    table = request.get('table', RT_TABLE_MAIN)
+    if command == 'del':
+        # Как у ip route del: под удаление подходит маршрут любого типа и
+        # области, а без proto — и с любой меткой
+        scope, rtype, proto = RT_SCOPE_NOWHERE, RTN_UNSPEC, request.get('proto', 0)
+    else:
+        scope, rtype, proto = RT_SCOPE_UNIVERSE, RTN_UNICAST, request.get('proto', RTPROT_BOOT)
+    address = socket.inet_pton(family, dst)
+    parts = [RTMSG.pack(family, prefixlen, 0, 0, table if table < 256 else RT_TABLE_COMPAT,
+                        proto, scope, rtype, 0),
+             RTATTR.pack(RTATTR.size + len(address), RTA_DST), address]
+    gateway = request.get('gateway')
+    if gateway is not None:
+        address = socket.inet_pton(family, gateway)
+        parts += [RTATTR.pack(RTATTR.size + len(address), RTA_GATEWAY), address]
+    for key, attr in U32_ATTRS:
+        if key in request:
+            parts.append(RTATTR_U32.pack(RTATTR_U32.size, attr, request[key]))
+    # Адреса 4 и 16 байт: выравнивание до 4 сохраняется само
+    return b''.join(parts)
+
+
+def dump_routes(table: int = RT_TABLE_MAIN, oif: int = None, proto: int = None, family=socket.AF_UNSPEC):
+    """Дамп маршрутов: (сеть, шлюз, метрика, proto) на маршрут с RTA_DST.
+
+    Из сообщений читаются только нужные атрибуты. Фильтры применяет ядро
+    (NETLINK_GET_STRICT_CHK), а если оно старое — они же проверяются здесь.
+    """
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        try:
+            sock.setsockopt(SOL_NETLINK, NETLINK_GET_STRICT_CHK, 1)
+        except OSError:
+            pass
+        body = [RTMSG.pack(family, 0, 0, 0, table if table is not None and table < 256 else 0,
+                           proto or 0, 0, 0, 0)]
+        if table is not None:
+            body.append(RTATTR_U32.pack(RTATTR_U32.size, RTA_TABLE, table))
+        if oif is not None:
+            body.append(RTATTR_U32.pack(RTATTR_U32.size, RTA_OIF, oif))
+        body = b''.join(body)
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(body), RTM_GETROUTE, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + body)
+
+        buffer = bytearray(RECV_BUFFER)
+        while True:
+            length = sock.recv_into(buffer)
+            offset = 0
+            while offset + NLMSGHDR.size <= length:
+                size, message_type, _, _, _ = NLMSGHDR.unpack_from(buffer, offset)
+                if size < NLMSGHDR.size:
+                    break
+                if message_type == NLMSG_DONE:
+                    return
+                if message_type == NLMSG_ERROR:
+                    code = -NLMSGERR.unpack_from(buffer, offset + NLMSGHDR.size)[0]
+                    if code:
+                        raise OSError(code, os.strerror(code))
+                    return
+                route = parse_route(buffer, offset + NLMSGHDR.size, offset + size)
+                if (route is not None and (table is None or route[4] == table)
+                        and (oif is None or route[5] == oif) and (proto is None or route[3] == proto)):
+                    yield route[:4]
+                offset += (size + 3) & ~3
+
+
+def parse_route(buffer, offset: int, end: int):
+    """RTM_NEWROUTE -> (сеть, шлюз, метрика, proto, таблица, oif) или None без RTA_DST"""
+    family, prefixlen, _, _, table, proto, _, _, _ = RTMSG.unpack_from(buffer, offset)
+    offset += RTMSG.size
+    dst = gateway = oif = None
+    metric = 0
+    while offset + RTATTR.size <= end:
+        size, attr = RTATTR.unpack_from(buffer, offset)
+        if size < RTATTR.size:
+            break
+        value = offset + RTATTR.size
+        if attr == RTA_DST:
+            dst = socket.inet_ntop(family, bytes(buffer[value:offset + size]))
+        elif attr == RTA_GATEWAY:
+            gateway = socket.inet_ntop(family, bytes(buffer[value:offset + size]))
+        elif attr == RTA_PRIORITY:
+            metric = RTATTR_U32.unpack_from(buffer, offset)[2]
+        elif attr == RTA_TABLE:
+            table = RTATTR_U32.unpack_from(buffer, offset)[2]
+        elif attr == RTA_OIF:
+            oif = RTATTR_U32.unpack_from(buffer, offset)[2]
+        offset += (size + 3) & ~3
+    if dst is None:
+        return None
+    return f'{dst}/{prefixlen}', gateway, metric, proto, table, oif
+
+
+class Window:
+    """Окно запросов в полёте, AIMD как у TCP.
+
+    Каждый круг ACK без перегрузки окно растёт на 1, при ENOBUFS и
+    потерянных ACK — уменьшается вдвое, при долгих ACK — на четверть.
+    После уменьшения следующее возможно только через круг: ACK запросов,
+    отправленных до него, о новом окне ещё ничего не говорят.
+    """
+
+    def __init__ (self, maximum: int, limit: int = INITIAL_WINDOW):
+        self.maximum = max(1, maximum)
+        self.limit = float(min(self.maximum, max(1, limit)))
+        # Сколько запросов сейчас в полёте, ведёт BulkRoute
+        self.in_flight = 0
+        self.hold = 0
+
+    def ack(self, latency: float) -> bool:
+        """Учитывает ACK; True, если окно пришлось сузить"""
+        if self.hold > 0:
+            self.hold -= 1
+        if latency > LATENCY_TARGET:
+            return self.decrease(0.75)
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        return False
+
+    def decrease(self, factor: float) -> bool:
+        if self.hold > 0:
+            return False
+        self.limit = max(1.0, self.limit * factor)
+        self.hold = self.in_flight
+        return True
+
+
+class BulkResult:
+    """Итог пакетной операции: что прошло, что пропущено и что упало"""
+
+    def __init__ (self, command: str):
+        self.command = command
+        self.ok = []
+        self.skipped = []
+        self.failed = []
+
+    def __len__ (self):
+        return len(self.ok) + len(self.skipped) + len(self.failed)
+
+    def report(self, iface_name: str = ''):
+        """Печатает ошибки по каждому маршруту одним блоком"""
+        for route, error in self.failed:
+            print(f"[-] Ошибка {self.command} {route['network']}: {error}")
+        print(f"[+] {self.command}: успешно {len(self.ok)}, пропущено {len(self.skipped)}, "
+              f"ошибок {len(self.failed)} {iface_name}")
+
+
+class Feed:
+    """Задания для BulkRoute: итератор или, если он блокирует, поток с очередью"""
+    # Источник ещё не иссяк, но готовых заданий пока нет
+    EMPTY = object()
+
+    def __init__ (self, items, blocking: bool = False):
+        self.pending = iter(items)
+        self.queue = None
+        self.error = None
+        if blocking:
+            # Очередь ограничена: разбор не уходит далеко вперёд установки
+            self.queue = queue.Queue(maxsize=2 * FEED_CHUNK)
+            threading.Thread(target=self.fill, daemon=True).start()
+
+    def fill(self):
+        try:
+            for item in self.pending:
+                self.queue.put(item)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def take(self, wait: bool):
+        """Следующее задание; None — заданий больше нет, EMPTY — пока нет (только без wait)"""
+        if self.queue is None:
+            return next(self.pending, None)
+        try:
+            item = self.queue.get(wait)
+        except queue.Empty:
+            return self.EMPTY
+        if item is None:
+            # Дальше очередь пуста навсегда: None возвращается и следующим вызовам
+            self.queue.put(None)
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+        return item
+
+
+class BulkRoute:
+    """Пакетная отправка RTM_NEWROUTE/RTM_DELROUTE через один netlink-сокет.
+
+    Запросы не ждут ACK друг друга: одновременно отправлено столько
+    сообщений, сколько позволяет окно (см. Window, не больше window), и
+    уходят они одним send; подтверждения и ошибки собираются по мере
+    прихода, по seq.
+
+    Если ответы не помещаются в буфер приёма, ядро их выбрасывает и
+    сообщает ENOBUFS. Тогда буфер удваивается, а запросы, ответы на
+    которые могли пропасть, отправляются заново — add и del идемпотентны
+    (EEXIST и ESRCH после потери считаются успехом).
+    """
+    # Ошибки, которые означают, что маршрут уже в нужном состоянии
+    IDEMPOTENT = {
+        'add': errno.EEXIST,
+        'del': errno.ESRCH,
+    }
+
+    def __init__ (self, window: int = DEFAULT_WINDOW, stats=None, rcvbuf: int = DEFAULT_RCVBUF):
+        # Окно и буфер переживают вызовы run: add, replace и del reload
+        # начинают с того, что уже узнали о ядре
+        self.window = Window(window)
+        self.rcvbuf = rcvbuf
+        # stats — rstats.Stats для задержек и итогов по маршрутам, None — без замеров
+        self.stats = stats
+        self.sock = None
+        self.seq = 0
+        self.buffer = bytearray(RECV_BUFFER)
+        # Порядок повторов с одинаковым сроком
+        self.order = itertools.count()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def run(self, command: str, items, done=None, blocking: bool = False) -> BulkResult:
+        """items — итерируемое пар (route, аргументы IPRoute.route).
+
+        done(command, route) вызывается сразу на каждый маршрут, который
+        оказался в нужном состоянии (ok или skipped), не дожидаясь конца пакета.
+        blocking — items надолго блокирует (разбор конфига с DNS): он читается
+        в отдельном потоке, а ACK тем временем принимаются.
+        """
+        if self.sock is None:
+            self.sock = self.open()
+        result = BulkRun(self, command, done).run(Feed(items, blocking))
+        if self.stats is not None:
+            self.stats.count('routes', len(result.ok), command=command, result='ok')
+            self.stats.count('routes', len(result.skipped), command=command, result='skipped')
+            self.stats.count('routes', len(result.failed), command=command, result='failed')
+        return result
+
+    def open(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE)
+        sock.bind((0, 0))
+        try:
+            sock.setsockopt(SOL_NETLINK, NETLINK_CAP_ACK, 1)
+        except OSError:
+            # Ядро до 4.3: ошибки придут с копией запроса
+            pass
+        self.set_rcvbuf(sock)
+        return sock
+
+    def set_rcvbuf(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, self.rcvbuf)
+        except OSError:
+            # Без CAP_NET_ADMIN остаётся то, что разрешает rmem_max
+            pass
+
+    def grow(self):
+        """Вдвое больший буфер приёма после ENOBUFS"""
+        self.rcvbuf = min(RCVBUF_MAX, self.rcvbuf * 2)
+        self.set_rcvbuf(self.sock)
+
+    def next_seq(self) -> int:
+        # 0 не используем: так ядро отвечает на сообщения без seq
+        self.seq = self.seq % 0xFFFFFFFF + 1
+        return self.seq
+
+    def count(self, name: str, value: int = 1, **labels):
+        if self.stats is not None:
+            self.stats.count(name, value, **labels)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class BulkRun:
+    """Один вызов BulkRoute.run: запросы в полёте, повторы и итог"""
+
+    def __init__ (self, bulk: BulkRoute, command: str, done=None):
+        self.bulk = bulk
+        self.command = command
+        self.done = done
+        self.message_type, self.flags = MESSAGES[command]
+        self.skip_code = BulkRoute.IDEMPOTENT.get(command)
+        self.result = BulkResult(command)
+        # seq -> [маршрут, тело сообщения, попытка, терялся ли ответ, время отправки]
+        self.in_flight = {}
+        # Куча (когда повторить, порядок, запрос)
+        self.retries = []
+        # Когда пришёл последний ответ (для ACK_TIMEOUT)
+        self.acked = time.perf_counter()
+
+    def run(self, feed: Feed) -> BulkResult:
+        bulk = self.bulk
+        window = bulk.window
+        in_flight = self.in_flight
+        retries = self.retries
+        exhausted = False
+        while True:
+            now = time.perf_counter()
+            # Дописываем окно: сначала повторы, чей срок подошёл, потом новые
+            batch = []
+            size = 0
+            while len(in_flight) < int(window.limit) and size < SEND_BATCH:
+                if retries and retries[0][0] <= now:
+                    entry = heapq.heappop(retries)[2]
+                elif not exhausted:
+                    # Ждать источник можно, только если ждать больше нечего
+                    item = feed.take(wait=not in_flight and not retries and not batch)
+                    if item is Feed.EMPTY:
+                        break
+                    if item is None:
+                        exhausted = True
+                        continue
+                    route, request = item
+                    try:
+                        entry = [route, encode_route(self.command, request), 0, False, 0.0]
+                    except (OSError, ValueError, KeyError) as e:
+                        # Например, адрес шлюза не того семейства
+                        self.result.failed.append((route, e))
+                        continue
+                else:
+                    break
+                seq = bulk.next_seq()
+                entry[4] = now
+                in_flight[seq] = entry
+                batch.append(seq)
+                size += NLMSGHDR.size + len(entry[1])
+            window.in_flight = len(in_flight)
+
+            if batch:
+                self.send(batch, size)
+            if not in_flight:
+                if retries:
+                    time.sleep(max(0.0, retries[0][0] - time.perf_counter()))
+                    continue
+                if exhausted:
+                    return self.result
+                continue
+            self.receive()
+
+    def send(self, batch, size: int):
+        message = bytearray(size)
+        offset = 0
+        for seq in batch:
+            body = self.in_flight[seq][1]
+            length = NLMSGHDR.size + len(body)
+            NLMSGHDR.pack_into(message, offset, length, self.message_type, self.flags, seq, 0)
+            message[offset + NLMSGHDR.size:offset + length] = body
+            offset += length
+        try:
+            self.bulk.sock.send(message)
+        except OSError as e:
+            if e.errno not in TRANSIENT:
+                raise
+            # Сообщение не принято целиком: ни один запрос не ушёл
+            for seq in batch:
+                self.complete(self.in_flight.pop(seq), e.errno, time.perf_counter())
+
+    def receive(self):
+        """Принимает ответы, пока есть; ждёт не дольше ACK_TIMEOUT и срока повторов"""
+        bulk = self.bulk
+        sock = bulk.sock
+        buffer = bulk.buffer
+        in_flight = self.in_flight
+        timeout = ACK_TIMEOUT / 4
+        if self.retries:
+            timeout = max(0.0, min(timeout, self.retries[0][0] - time.perf_counter()))
+        sock.settimeout(timeout)
+        while in_flight:
+            try:
+                length = sock.recv_into(buffer)
+            except (socket.timeout, BlockingIOError):
+                if time.perf_counter() - self.acked > ACK_TIMEOUT:
+                    self.lose('lost')
+                return
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # Ответы, не поместившиеся в буфер, пропали
+                self.lose('ENOBUFS')
+                return
+            now = self.acked = time.perf_counter()
+            offset = 0
+            while offset + NLMSGHDR.size <= length:
+                size, message_type, _, seq, _ = NLMSGHDR.unpack_from(buffer, offset)
+                if size < NLMSGHDR.size:
+                    break
+                if message_type == NLMSG_ERROR:
+                    entry = in_flight.pop(seq, None)
+                    # Чужой seq — ответ на запрос, который уже отправлен заново
+                    if entry is not None:
+                        self.complete(entry, -NLMSGERR.unpack_from(buffer, offset + NLMSGHDR.size)[0], now)
+                offset += (size + 3) & ~3
+            # Остальное в буфере забираем не дожидаясь
+            sock.settimeout(0)
+        self.bulk.window.in_flight = len(in_flight)
+
+    def complete(self, entry, code: int, now: float):
+        bulk = self.bulk
+        window = bulk.window
+        route = entry[0]
+        if code == 0:
+            latency = now - entry[4]
+            if window.ack(latency):
+                bulk.count('netlink_window_decreases', reason='latency')
+            if bulk.stats is not None:
+                # Задержка от отправки до ACK, без ожидания места в окне
+                bulk.stats.observe('netlink_request_seconds', latency, command=self.command)
+            self.result.ok.append(route)
+        elif code == self.skip_code:
+            # После потерянного ответа EEXIST/ESRCH — это наш же первый запрос
+            (self.result.ok if entry[3] else self.result.skipped).append(route)
+        elif code in TRANSIENT and entry[2] < RETRIES:
+            if code in CONGESTION and window.decrease(0.5):
+                bulk.count('netlink_window_decreases', reason=errno.errorcode[code])
+            bulk.count('netlink_retries', command=self.command, reason=errno.errorcode[code])
+            self.retry(entry, now + RETRY_DELAY * 2 ** entry[2])
+            return
+        else:
+            self.result.failed.append((route, OSError(code, os.strerror(code))))
+            return
+        if self.done is not None:
+            self.done(self.command, route)
+
+    def retry(self, entry, when: float):
+        entry[2] += 1
+        heapq.heappush(self.retries, (when, next(self.bulk.order), entry))
+
+    def lose(self, reason: str):
+        """Ответы на всё, что в полёте, потеряны: отправить заново, буфер — больше"""
+        bulk = self.bulk
+        if bulk.window.decrease(0.5):
+            bulk.count('netlink_window_decreases', reason=reason)
+        bulk.grow()
+        now = time.perf_counter()
+        for entry in self.in_flight.values():
+            # Был ли применён запрос — неизвестно, повтор покажет
+            entry[3] = True
+            if entry[2] < RETRIES:
+                bulk.count('netlink_retries', command=self.command, reason=reason)
+                self.retry(entry, now)
+            else:
+                self.result.failed.append((entry[0], LOST))
+        self.in_flight.clear()
+        bulk.window.in_flight = 0
+        self.acked = now
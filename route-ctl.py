@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import json
+import sys
+
+import rcontrol
+
+# Тонкий клиент демона route-manager.py для хуков OpenVPN:
+#   route-up "/opt/openvpn/route-ctl up tun0"
+#   route-pre-down "/opt/openvpn/route-ctl down"
+# Лишние аргументы, которые дописывает OpenVPN, игнорируются.
+
+def usage():
+    print(f"Использование: {sys.argv[0]} up|down|reload|import|status|stats [интерфейс] [--socket=путь]")
+    return 2
+
+
+def main(argv):
+    socket_path = rcontrol.SOCKET_PATH
+    args = []
+    for arg in argv:
+        if arg.startswith('--socket='):
+            socket_path = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+
+    if not args or args[0] not in rcontrol.COMMANDS:
+        return usage()
+    command = args[0]
+    interface = args[1] if len(args) > 1 else None
+
+    try:
+        reply = rcontrol.request(command, interface, socket_path)
+    except (OSError, ValueError) as e:
+        print(f"[-] Демон на {socket_path} недоступен: {e}")
+        return 1
+
+    if command == 'stats' and 'stats' in reply:
+        print(json.dumps(reply['stats'], indent=2, ensure_ascii=False))
+        return 0
+    for key, value in reply.items():
+        if key != 'ok':
+            print(f"{key}: {value}")
+    return 0 if reply.get('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
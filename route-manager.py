@@ -1,28 +1,108 @@
 #!/usr/bin/env python
-from pyroute2 import IPRoute
 import argparse
-import json
+import errno
+import itertools
+import fcntl
+import signal
+import socket
+import socketserver
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+import rcache
 import rconfig
+import rcontrol
+import rdnscache
+import rdump
+import rimport
+import rjournal
+import rnetlink
+import rplan
+import rpyroute
+import rresolver
+import rstats
+import rtable
 
-# pyinstaller --onefile route-manager.py
+# pyinstaller route-manager.spec (onedir: dist/route-manager/route-manager)
 
 BACKUP_FILE="./route_backup.json"
 CURRENT_ROUTES_FILE="./current_routes.json"
+# Приоритет ip rule, который направляет трафик в таблицу маршрутов VPN
+RULE_PRIORITY = 100
+# Метка proto наших маршрутов: по ней ядро само отдаёт их при снятии.
+# Значения до 4 заняты ядром, известные демоны (bird, zebra, ...) — ниже 150.
+RT_PROTO = 150
+# Метка маршрутов по доменам (domains): их ставит и снимает DomainRouter по
+# TTL, поэтому up и reload их не трогают, а down снимает вместе с нашими
+RT_DOMAIN_PROTO = 151
+
+def state_file(interface: str, state_dir: str = None) -> str:
+    """Файл состояния интерфейса. Без state_dir — прежний общий файл"""
+    if state_dir is None:
+        return CURRENT_ROUTES_FILE
+    return os.path.join(state_dir, f'current_routes.{interface}.json')
+
+
+def dns_cache_file(interface: str, state_dir: str = None) -> str:
+    """Кэш DNS интерфейса: у туннелей в state_dir свой, иначе прежний общий"""
+    if state_dir is None:
+        return rdnscache.DNS_CACHE_FILE
+    return os.path.join(state_dir, f'dns_cache.{interface}.json')
+
 
 class RouteManager:
-    def __init__ (self, config_file: str, iface_name: str = 'tun0',  backup_file: str = BACKUP_FILE, current_routes_file:str = CURRENT_ROUTES_FILE):
+    def __init__ (self, config_file: str, iface_name: str = 'tun0',  backup_file: str = BACKUP_FILE, current_routes_file:str = CURRENT_ROUTES_FILE, window: int = rnetlink.DEFAULT_WINDOW,
+                  dns_workers: int = rresolver.DNS_WORKERS, dns_timeout: float = rresolver.DNS_TIMEOUT,
+                  dns_cache: str = rdnscache.DNS_CACHE_FILE, aggregate: bool = True, stream: bool = False,
+                  route_cache: str = None, table: int = None, rule_priority: int = RULE_PRIORITY,
+                  stats: rstats.Stats = None, proto: int = RT_PROTO, rcvbuf: int = rnetlink.DEFAULT_RCVBUF,
+                  domain_proto: int = RT_DOMAIN_PROTO):
         self.config_file = config_file
-        with rconfig.RouteConfig(config_file) as config:
-            self.routes = config.routes
-        self.current_routes = []
+        # Время фаз, задержки netlink и итоги по маршрутам (см. rstats)
+        self.stats = stats if stats is not None else rstats.Stats()
+        # stream — маршруты ставятся по мере разбора конфига, без агрегации
+        self.stream = stream
+        self.config_options = dict(dns_workers=dns_workers, dns_timeout=dns_timeout,
+                                   dns_cache=dns_cache, aggregate=aggregate and not stream,
+                                   lazy=stream, route_cache=route_cache, stats=self.stats)
+        # Конфиг разбирается при первом обращении к routes (см. __getattr__):
+        # down снимает маршруты по дампу ядра, и конфиг ему не нужен
+        self.config_loaded = False
         self.iface_name = iface_name
         self.backup_file = backup_file
         self.current_routes_file = current_routes_file
-        self.ip_route = IPRoute()
+        # Файл состояния ведётся журналом: запись на каждый ACK, снимок — при сжатии
+        self.journal = rjournal.RouteJournal(current_routes_file)
+        self.ip_route = rdump.open_iproute()
+        self.window = window
+        self.rcvbuf = rcvbuf
+        self.bulk = None
+        # table — маршруты ставятся в отдельные таблицы table и table + 1,
+        # трафик переключается между ними одним ip rule (см. switch_table)
+        self.table = table
+        self.rule_priority = rule_priority
+        # Маршруты ставятся с proto, снимаются по дампу ядра с тем же proto
+        self.proto = proto
+        self.domain_proto = domain_proto
         
+    def load_config(self):
+        """(Пере)читывает конфиг маршрутов"""
+        with rconfig.RouteConfig(self.config_file, **self.config_options) as config:
+            self.routes = config.routes
+            self.resolver = config.resolver
+            self.pending = config.iter_routes() if self.stream else None
+        self.config_loaded = True
+
+    def __getattr__ (self, name):
+        """routes, resolver и pending появляются после разбора конфига"""
+        if name in ('routes', 'resolver', 'pending') and not self.__dict__.get('config_loaded', True):
+            self.load_config()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     def __enter__ (self):
         """Нужно для обработки with"""
         return self
@@ -42,6 +122,8 @@ class RouteManager:
                 print(f"[-] Интерфейс {self.iface_name} не найден!")
                 return None
             
+            self.iface_index = idx[0]
+
             # Получаем все адреса интерфейса
             addrs = self.ip_route.get_addr(index=idx[0])
             
@@ -53,6 +135,7 @@ class RouteManager:
             tun_ip = addrs[0].get_attr('IFA_ADDRESS')
             tun_prefix = addrs[0]['prefixlen']
             self.iface_ip = f'{tun_ip}/{tun_prefix}'
+            self.iface_addr = tun_ip
             
             print(f"[+] Интерфейс {self.iface_name}: {self.iface_ip}")
             
@@ -62,67 +145,518 @@ class RouteManager:
             print('Ошибка {e}')
             return None            
 
+    @contextmanager
+    def state_lock(self):
+        """Исключительная блокировка файла состояния на время операции.
+
+        Два процесса с одним интерфейсом выполняют команды по очереди и
+        не затирают состояние друг друга.
+        """
+        with open(f'{self.current_routes_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Пока блокировки не было, состояние мог менять другой процесс
+            self.journal.forget()
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
     def save_current_routes(self):
-        """Сохраняет текущие маршруты в файл."""
+        """Сохраняет текущие маршруты в файл.
+
+        Сами маршруты уже записаны в журнал по мере установки, здесь
+        хвост журнала уходит на диск и при необходимости сжимается в снимок.
+        """
         try:
-            with open(self.current_routes_file, "w") as f:
-                # print(self.current_routes)
-                json.dump(self.current_routes, f, indent=4)
+            self.journal.commit()
         except OSError as e:
             print(f'Ошибка открытия файла: {e}')
 
-        print(f"[+] Сохранено {len(self.current_routes)} маршрутов в {BACKUP_FILE}")
+        print(f"[+] Сохранено {len(self.journal)} маршрутов в {self.current_routes_file}")
         
     def load_current_routes(self):
-        """Восстанавливает маршруты из файла."""
-        if not os.path.exists(self.current_routes_file):
+        """Восстанавливает маршруты из файла (снимок и хвост журнала)."""
+        if not self.journal.exists():
             print("[-] Файл с резервной копией маршрутов не найден!")
-            return
-        with open(self.current_routes_file, 'r') as f:
-            self.current_routes = json.load(f)
+            return []
+        return self.journal.load()
         
 
+    def route_gateway(self, route):
+        """Адрес шлюза для маршрута: vpn_gateway — это адрес интерфейса.
+
+        Маршрут IPv6 через vpn_gateway ставится без шлюза, просто на
+        интерфейс (dev tun0): адрес интерфейса у туннеля — IPv4.
+        """
+        if route['gateway'] == 'vpn_gateway':
+            return None if ':' in route['network'] else self.iface_addr
+        return route['gateway']
+
+    def route_metric(self, route):
+        """Метрика маршрута числом; если не задана — как у ядра (0, у IPv6 — 1024)"""
+        if route['metric'] is None:
+            return rtable.default_metric(route['network'])
+        return int(route['metric'])
+
+    def route_request(self, route, table=None):
+        """Аргументы IPRoute.route для маршрута из конфига"""
+        gateway = self.route_gateway(route)
+        if ':' in route['network']:
+            request = {'dst': route['network'], 'family': socket.AF_INET6, 'oif': self.iface_index}
+            if gateway is not None:
+                request['gateway'] = gateway
+        else:
+            request = {'dst': route['network'], 'gateway': gateway}
+        if route['metric'] is not None:
+            request['priority'] = self.route_metric(route)
+        if table is not None:
+            request['table'] = table
+            request['oif'] = self.iface_index
+        return request
+
+    def bulk_route(self, command, routes, table=None, proto=None, report=True, blocking=False):
+        """Отправляет маршруты пакетом через один netlink-сокет.
+
+        proto — своя метка вместо self.proto (маршруты по доменам), такие
+        маршруты в файл состояния не пишутся. blocking — routes отдаются
+        разбором конфига (с DNS) и читаются в отдельном потоке.
+        """
+        if self.bulk is None:
+            self.bulk = rnetlink.BulkRoute(window=self.window, stats=self.stats, rcvbuf=self.rcvbuf)
+        items = ((route, self.route_request(route, table)) for route in routes)
+        if command != 'del' or proto is not None:
+            # Удаление без proto: так снимаются и маршруты старых версий без метки.
+            # Со своей меткой ядро удалит только маршрут с ней, а не такой же из конфига
+            tag = self.proto if proto is None else proto
+            items = ((route, {**request, 'proto': tag}) for route, request in items)
+        # Маршруты основной таблицы журналируются по каждому ACK; состояние
+        # отдельных таблиц целиком задаёт switch_table
+        done = self.journal.record if table is None and proto is None else None
+        with self.stats.phase(f'netlink_{command}'):
+            result = self.bulk.run(command, items, done, blocking)
+        if report and len(result):
+            result.report(self.iface_name)
+        return result
+
+    def stream_routes(self):
+        """Маршруты по мере разбора конфига: чтение, DNS и установка идут внахлёст"""
+        for network, prefixlen, metric, gateway, family in self.pending:
+            self.routes.append(network, prefixlen, metric, gateway, family)
+            yield self.routes[-1]
+        self.pending = None
+
+    def drain_routes(self):
+        """Дочитывает конфиг, если маршруты ещё отдаются потоком"""
+        if self.config_loaded and self.pending is not None:
+            for _ in self.stream_routes():
+                pass
+
     def add_routes(self):
-        """Добавляет маршруты к интерфейсу {self.iface_name}"""
-        counter = 0
-        for route in self.routes:
-            gateway = self.iface_ip
-            if route['gateway'] != 'vpn_gateway':
-                gateway = route['gateway']
-            try:
-                self.ip_route.route("add", dst=route["network"], gateway=gateway)
-                # print(res)
-                print(f"[+] Добавлен маршрут {route['network']} через {self.iface_name}")
-                self.current_routes.append(route)
-                counter += 1
-            except Exception as e:
-                print(f'[-] Ошибка добавления маршрута: {e}')
-                    
-        self.save_current_routes()
-        print(f"[+] Добавлено {counter} маршрутов к {self.iface_name}")
+        """Добавляет маршруты к интерфейсу {self.iface_name}.
+
+        Выполняется тот же план, что показывает up --dry-run.
+        """
+        if self.table is not None:
+            return self.switch_table()
+        if self.pending is not None:
+            # --stream: план до конца разбора не построить. replace ставит
+            # маршрут или меняет шлюз уже стоящего — итог тот же, что у плана,
+            # кроме снятия маршрутов со сменившейся метрикой (это сделает reload)
+            result = self.bulk_route("replace", self.stream_routes(), blocking=True)
+            self.save_current_routes()
+            print(f"[+] Добавлено {len(result.ok)} маршрутов к {self.iface_name}")
+            self.import_feeds(full=True)
+            return result
+        plan = self.plan('up')
+        plan.report(operations=False)
+        added, replaced, _ = self.apply_plan(plan, check=False)
+        print(f"[+] Добавлено {len(added.ok)}, заменено {len(replaced.ok)} маршрутов к {self.iface_name}")
+        return added
         
                     
     def remove_routes(self):
         """Удаляет маршруты из интерфейса {self.iface_name}"""
-        counter = 0
-        if os.path.exists(self.current_routes_file):
-            self.load_current_routes()
-        else:
-            self.current_routes = self.routes
+        if self.table is not None:
+            return self.release_table()
+        _, _, removed = self.apply_plan(self.plan('down'), check=False)
+        print(f"[+] Удалено {len(removed.ok)} маршрутов из {self.iface_name}")
+        return removed
+
+
+    def feed_state_file(self):
+        """Что из источников route-import уже стоит (см. rimport.FeedState)"""
+        return f'{self.current_routes_file}.feeds'
+
+    def config_feeds(self):
+        with rconfig.RouteConfig(self.config_file, lazy=True) as config:
+            return list(config.iter_imports())
+
+    def import_feeds(self, full=False):
+        """Ставит только разницу источников route-import с прошлого импорта.
+
+        Источник, файл которого не менялся, даже не перечитывается.
+        full — поставить всё заново (после up, когда состояние могло устареть).
+        """
+        feeds = self.config_feeds()
+        state = rimport.FeedState(self.feed_state_file())
+        if not feeds and not state.feeds:
+            return []
+        if self.table is not None:
+            # Таблицы переключаются целиком, источники входят в switch_table
+            return [self.switch_table()]
+        with self.stats.phase('import'):
+            to_add, to_delete = state.refresh(feeds, full)
+        if to_delete:
+            # Префикс ушёл из источника, но есть в конфиге: маршрут ещё нужен
+            if not self.config_loaded:
+                self.load_config()
+            self.drain_routes()
+            wanted = {route['network'] for route in self.routes}
+            to_delete = [route for route in to_delete if route['network'] not in wanted]
+        added = self.bulk_route("add", to_add)
+        removed = self.bulk_route("del", to_delete)
+        state.discard(route for route, error in added.failed)
+        state.save()
+        self.save_current_routes()
+        print(f"[+] Источники для {self.iface_name}: добавлено {len(added.ok)}, удалено {len(removed.ok)}")
+        return [added, removed]
+
+    def installed_routes(self, table=rdump.RT_TABLE_MAIN, oif=True, proto=None):
+        """Маршруты, реально установленные на интерфейсе: network -> (gateway, metric).
+
+        Дамп один на оба семейства (AF_UNSPEC), ядро фильтрует его само.
+        """
+        with self.stats.phase('netlink_dump'):
+            return {network: (gateway, metric) for network, gateway, metric, _ in
+                    rnetlink.dump_routes(table=table, oif=self.iface_index if oif else None, proto=proto)}
+
+    def kernel_routes(self, table=rdump.RT_TABLE_MAIN, oif=True, proto=None):
+        """installed_routes списком маршрутов для bulk_route"""
+        return [{'network': network, 'gateway': gateway, 'metric': metric or None}
+                for network, (gateway, metric) in self.installed_routes(table, oif, proto).items()]
+
+    def snapshot(self) -> dict:
+        """Маршруты интерфейса в основной таблице одним дампом: network -> (gateway, metric, proto).
+
+        Если на ту же сеть стоит и чужой маршрут (с другой метрикой), в
+        снимок попадает наш: иначе чужой сошёл бы за наш и был бы удалён.
+        """
+        routes = {}
+        with self.stats.phase('netlink_dump'):
+            for network, gateway, metric, proto in rnetlink.dump_routes(table=rdump.RT_TABLE_MAIN,
+                                                                        oif=self.iface_index):
+                if network not in routes or proto == self.proto:
+                    routes[network] = (gateway, metric, proto)
+        return routes
+
+    def plan_snapshot(self, command) -> dict:
+        """Снимок, по которому строится план команды (и сверяется apply)"""
+        snapshot = self.snapshot()
+        if command != 'down':
+            # Маршруты по доменам живут своим сроком, up и reload их не касаются
+            snapshot = {network: route for network, route in snapshot.items() if route[2] != self.domain_proto}
+        return snapshot
+
+    def plan(self, command):
+        """План изменений для up, down или reload (см. rplan): ядро читается одним дампом"""
+        if self.table is not None:
+            raise ValueError("План строится только для основной таблицы, без --table")
+        if command not in rplan.COMMANDS:
+            raise ValueError(f"Для {command} план не строится")
+        self.drain_routes()
+        snapshot = self.plan_snapshot(command)
+        plan = rplan.Plan(command, self.iface_name, self.config_file, self.current_routes_file,
+                          self.proto, rplan.snapshot_digest(snapshot))
+        installed = {network: (gateway, metric) for network, (gateway, metric, _) in snapshot.items()}
+        # Удалять можно только то, что ставили мы сами: с нашей меткой proto
+        # или (для старых версий без метки) записанное в файле состояния
+        owned = {network for network, (_, _, proto) in snapshot.items()
+                 if proto == self.proto or (command == 'down' and proto == self.domain_proto)}
+
+        if command == 'down':
+            routes = [{'network': network, 'gateway': gateway, 'metric': metric or None}
+                      for network, (gateway, metric) in installed.items() if network in owned]
+            if self.journal.exists():
+                # Маршруты, поставленные до появления метки proto
+                routes += [route for route in self.load_current_routes()
+                           if route['gateway'] == 'vpn_gateway' and route['network'] not in owned]
+            plan.extend('del', routes)
+            # Маршруты источников снимаются вместе со всеми по метке proto
+            plan.feeds = {}
+            return plan
+
+        if not self.config_loaded:
+            self.load_config()
+        self.drain_routes()
+        if command == 'up':
+            # up ничего не снимает: маршрут со сменившейся метрикой встаёт рядом
+            owned = set()
+        elif self.journal.exists():
+            owned.update(route['network'] for route in self.load_current_routes())
+
+        desired = {route['network']: route for route in self.routes}
+        # Источники route-import: после up ставятся заново, иначе — перечитываются изменившиеся
+        feeds = rimport.FeedState(self.feed_state_file())
+        with self.stats.phase('import'):
+            feeds.refresh(self.config_feeds(), full=command == 'up')
+        for route in feeds.routes(feeds.feeds).values():
+            desired.setdefault(route['network'], route)
+        if feeds.feeds or os.path.exists(feeds.state_file):
+            plan.feeds = feeds.feeds
+
+        to_add, to_replace, to_delete, unchanged = rplan.diff(desired, installed, owned,
+                                                              self.route_gateway, self.route_metric)
+        plan.extend('add', to_add)
+        plan.extend('replace', to_replace)
+        plan.extend('del', to_delete)
+        # Совпавший маршрут без нашей метки поставил кто-то другой: в журнал
+        # его не пишем, иначе down снимет чужое
+        plan.unchanged = [route for route in unchanged if snapshot[route['network']][2] == self.proto]
+        plan.unchanged_count = len(unchanged)
+        return plan
+
+    def apply_plan(self, plan, check=True):
+        """Выполняет план по порядку: add, replace, del. Конфиг не разбирается.
+
+        check — сверить ядро с дампом, по которому план строился.
+        """
+        if plan.interface != self.iface_name:
+            raise ValueError(f"План для {plan.interface}, а не для {self.iface_name}")
+        if (check and plan.snapshot is not None
+                and rplan.snapshot_digest(self.plan_snapshot(plan.command)) != plan.snapshot):
+            print(f"[-] Маршруты {self.iface_name} менялись после построения плана: "
+                  f"уже сделанное будет пропущено")
+
+        added = self.bulk_route("add", plan.operations['add'])
+        replaced = self.bulk_route("replace", plan.operations['replace'])
+        removed = self.bulk_route("del", plan.operations['del'])
+
+        # Добавленные, заменённые и удалённые уже в журнале; наши без изменений —
+        # дописываем, если их там не было (например, после потери файла)
+        for route in plan.unchanged:
+            if route not in self.journal:
+                self.journal.record('add', route)
+
+        if plan.feeds is not None:
+            feeds = rimport.FeedState(self.feed_state_file())
+            if plan.feeds:
+                feeds.feeds = plan.feeds
+                feeds.discard(route for route, error in added.failed)
+                feeds.save()
+            else:
+                feeds.clear()
+        self.save_current_routes()
+        return added, replaced, removed
+
+    def reload_routes(self):
+        """Применяет к интерфейсу только разницу между конфигом и ядром"""
+        if self.table is not None:
+            return [self.switch_table()]
+        plan = self.plan('reload')
+        plan.report(operations=False)
+        return self.apply_plan(plan, check=False)
             
-        for route in self.current_routes:
-            if route['gateway'] == 'vpn_gateway':
-                try:
-                    res = self.ip_route.route("del", dst=route["network"], gateway=self.iface_ip)
-                    print(f"[+] Удалён маршрут {route['network']} через {self.iface_name}")
-                    # print(res)
-                    counter += 1
-                except Exception as e:
-                    print(f"[-] Ошибка удаления маршрута {route['network']}: {e}")
+    def vpn_tables(self):
+        return (self.table, self.table + 1)
+
+    def active_tables(self):
+        """Таблицы VPN, на которые сейчас указывает наше правило ip rule"""
+        active = []
+        for rule in self.ip_route.get_rules(family=socket.AF_INET):
+            table = rule.get_attr('FRA_TABLE') or rule['table']
+            if rule.get_attr('FRA_PRIORITY') == self.rule_priority and table in self.vpn_tables():
+                active.append(table)
+        return active
+
+    def vpn_rule(self, command, table):
+        """Правило ip rule на таблицу VPN, для IPv4 и IPv6 сразу.
+
+        Ошибки IPv6 не мешают IPv4: IPv6 может быть выключен, а правило,
+        поставленное версией без IPv6, при снятии просто не найдётся.
+        """
+        self.ip_route.rule(command, table=table, priority=self.rule_priority)
+        try:
+            self.ip_route.rule(command, table=table, priority=self.rule_priority, family=socket.AF_INET6)
+        except Exception as e:
+            if getattr(e, 'code', None) not in (errno.EAFNOSUPPORT, errno.ENOENT, errno.EEXIST):
+                raise
+
+    def flush_table(self, table):
+        """Удаляет все маршруты таблицы пакетом"""
+        return self.bulk_route("del", self.kernel_routes(table=table, oif=False), table=table)
+
+    def switch_table(self):
+        """Собирает маршруты в свободной таблице и переключает на неё трафик.
+
+        Пока таблица заполняется, трафик идёт по старой. Переключение —
+        это добавить правило на новую таблицу и удалить правило на старую,
+        два сообщения netlink независимо от числа маршрутов. В промежутке
+        действуют оба правила, так что пакеты не теряются.
+        """
+        self.drain_routes()
+        active = self.active_tables()
+        if len(active) >= len(self.vpn_tables()):
+            # Прошлое переключение прервалось между двумя правилами
+            self.vpn_rule("del", active[-1])
+            active = active[:-1]
+        target = next(table for table in self.vpn_tables() if table not in active)
+
+        self.flush_table(target)
+        # В новую таблицу источники route-import идут целиком
+        feeds = rimport.FeedState(self.feed_state_file())
+        feed_routes, _ = feeds.refresh(self.config_feeds(), full=True)
+        result = self.bulk_route("add", itertools.chain(self.routes, feed_routes), table=target)
+        feeds.discard(route for route, error in result.failed)
+        feeds.save()
+        self.journal.reset(result.ok)
+
+        self.vpn_rule("add", target)
+        for table in active:
+            self.vpn_rule("del", table)
+        print(f"[+] Трафик переключён на таблицу {target} ({len(result.ok)} маршрутов)")
+
+        # Старую таблицу чистим уже после переключения
+        for table in active:
+            self.flush_table(table)
+        self.save_current_routes()
+        return result
+
+    def release_table(self):
+        """Снимает правило (трафик сразу уходит в main) и чистит таблицы VPN"""
+        for table in self.active_tables():
+            self.vpn_rule("del", table)
+        print(f"[+] Правило приоритета {self.rule_priority} снято")
+        rimport.FeedState(self.feed_state_file()).clear()
+        results = [self.flush_table(table) for table in self.vpn_tables()]
+        result = results[0]
+        for other in results[1:]:
+            result.ok += other.ok
+            result.skipped += other.skipped
+            result.failed += other.failed
+        # Без правила оставшееся в таблицах трафик не направляет: наших маршрутов нет
+        self.journal.reset([])
+        print(f"[+] Удалено {len(result.ok)} маршрутов из таблиц {self.vpn_tables()}")
+        return result
+
+    def owned_routes(self):
+        """Индекс наших маршрутов: network -> маршрут (читать под state_lock)"""
+        if self.journal.exists():
+            # Пустой журнал после down — чинить нечего
+            routes = self.load_current_routes()
+        else:
+            routes = self.routes
+        return {route['network']: route for route in routes}
+
+    def repair_table(self):
+        """Таблица, в которой должны стоять маршруты"""
+        if self.table is None:
+            return rdump.RT_TABLE_MAIN
+        active = self.active_tables()
+        return active[0] if active else None
+
+    def missing_routes(self, owned):
+        """Наши маршруты, которых сейчас нет в ядре"""
+        table = self.repair_table()
+        if table is None:
+            return set()
+        installed = self.installed_routes(table=table, oif=False)
+        return {network for network in owned if network not in installed}
+
+    def repair(self, owned, missing):
+        """Ставит назад пропавшие маршруты; возвращает свежий индекс наших маршрутов.
+
+        Пропавший маршрут мог снять down или reload: перед починкой журнал
+        перечитывается под state_lock, и чинится только то, что в нём осталось.
+        missing меняется на месте: в нём остаются только маршруты, которые
+        поставить не удалось.
+        """
+        if not missing:
+            return owned
+        with self.state_lock():
+            owned = self.owned_routes()
+            # Не &=: с dict_keys он собирает новое множество, а не меняет missing
+            missing.intersection_update(owned)
+            if not missing:
+                return owned
+            table = self.repair_table()
+            if table is None:
+                print("[-] Правило на таблицу VPN снято, чинить нечего")
+                missing.clear()
+                return owned
+            result = self.bulk_route("add", [owned[network] for network in missing],
+                                     table=None if self.table is None else table)
+            self.journal.commit()
+        print(f"[+] Восстановлено {len(result.ok) + len(result.skipped)} из {len(missing)} маршрутов")
+        missing.clear()
+        for route, error in result.failed:
+            missing.add(route['network'])
+        return owned
+
+    def watch(self):
+        """Следит за событиями netlink и возвращает пропавшие маршруты.
+
+        Удаление маршрута видно по RTM_DELROUTE, и ставится назад только он.
+        При падении интерфейса ядро удаляет маршруты молча, поэтому после
+        его подъёма или смены адреса недостающие находятся одним дампом.
+        """
+        rtnl = rpyroute.rtnl()
+
+        with self.state_lock():
+            owned = self.owned_routes()
+        tables = {rdump.RT_TABLE_MAIN} if self.table is None else set(self.vpn_tables())
+        missing = self.missing_routes(owned)
+        owned = self.repair(owned, missing)
+
+        monitor = rpyroute.IPRoute()
+        monitor.bind(groups=rtnl.RTMGRP_IPV4_ROUTE | rtnl.RTMGRP_IPV6_ROUTE | rtnl.RTMGRP_LINK
+                     | rtnl.RTMGRP_IPV4_IFADDR)
+        print(f"[+] Слежу за {len(owned)} маршрутами на {self.iface_name}")
+        link_up = True
+        try:
+            while True:
+                resync = False
+                # get() отдаёт всё, что пришло одним recv: пачку событий чиним разом
+                for msg in monitor.get():
+                    event = msg['event']
+                    if event in ('RTM_DELROUTE', 'RTM_NEWROUTE'):
+                        dst = msg.get_attr('RTA_DST')
+                        table = msg.get_attr('RTA_TABLE') or msg['table']
+                        network = f"{dst}/{msg['dst_len']}"
+                        # С нашей меткой — мог поставить reload уже после чтения журнала
+                        if (dst is None or table not in tables
+                                or (network not in owned and msg['proto'] != self.proto)):
+                            continue
+                        if event == 'RTM_DELROUTE':
+                            missing.add(network)
+                        else:
+                            missing.discard(network)
+                    elif event in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                        if msg.get_attr('IFLA_IFNAME') != self.iface_name:
+                            continue
+                        up = event == 'RTM_NEWLINK' and bool(msg['flags'] & 1)
+                        if up and not link_up:
+                            print(f"[+] Интерфейс {self.iface_name} поднялся")
+                            resync = True
+                        elif not up and link_up:
+                            print(f"[-] Интерфейс {self.iface_name} упал")
+                        link_up = up
+                    elif event == 'RTM_NEWADDR' and msg['index'] == getattr(self, 'iface_index', None):
+                        resync = True
+
+                if not link_up:
                     continue
-        print(f"[+] Удалено {counter} маршрутов из {self.iface_name}")                    
+                if resync:
+                    if not self.get_interface_ip(self.iface_name):
+                        continue
+                    with self.state_lock():
+                        owned = self.owned_routes()
+                    missing = self.missing_routes(owned)
+                owned = self.repair(owned, missing)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            monitor.close()
 
-            
     def check_interface_exists(self, interface_name):
         try:
             # Получаем список всех доступных интерфейсов
@@ -139,27 +673,287 @@ class RouteManager:
             return False
     
     def close(self):
+        # Фоновое обновление кэша DNS не ждём: хук OpenVPN должен выйти сразу,
+        # свежие адреса подхватит следующий запуск
+        if self.bulk is not None:
+            self.bulk.close()
+        self.journal.close()
         self.ip_route.close()
         
+class RouteDaemon(socketserver.UnixStreamServer):
+    """Резидентный режим: RouteManager на каждый туннель и команды через Unix-сокет.
+
+    Команды выполняются по одной, в порядке поступления. Команда без
+    интерфейса относится ко всем туннелям, они обрабатываются параллельно.
+    """
+
+    def __init__ (self, managers: dict, socket_path: str = rcontrol.SOCKET_PATH,
+                  stats_file: str = None):
+        # интерфейс -> RouteManager
+        self.managers = managers
+        self.socket_path = socket_path
+        # Файл статистики обновляется после каждой команды
+        self.stats_file = stats_file
+        self.started = time.time()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, RouteDaemonHandler)
+        os.chmod(socket_path, 0o660)
+
+    def handle_command(self, command: str, interface: str = None) -> dict:
+        if command not in rcontrol.COMMANDS:
+            return {'ok': False, 'error': f"Неизвестная команда {command}"}
+        if interface and interface not in self.managers:
+            return {'ok': False, 'error': f"Демон управляет {', '.join(self.managers)}, а не {interface}"}
+        interfaces = [interface] if interface else list(self.managers)
+
+        if command == 'stats':
+            stats = [self.managers[name].stats.snapshot() for name in interfaces]
+            return {'ok': True, 'stats': stats[0] if len(stats) == 1 else stats}
+        if command == 'status':
+            replies = [self.status(name) for name in interfaces]
+        else:
+            with ThreadPoolExecutor(max_workers=len(interfaces)) as executor:
+                replies = list(executor.map(lambda name: self.run_command(command, name), interfaces))
+            if self.stats_file:
+                rstats.save(self.stats_file, *(manager.stats for manager in self.managers.values()))
+
+        if len(replies) == 1:
+            return replies[0]
+        return {'ok': all(reply['ok'] for reply in replies),
+                'tunnels': dict(zip(interfaces, replies))}
+
+    def run_command(self, command: str, interface: str) -> dict:
+        manager = self.managers[interface]
+        # Адрес туннеля мог смениться после переподключения
+        if not manager.get_interface_ip(interface):
+            return {'ok': False, 'error': f"Интерфейс {interface} недоступен"}
+        with manager.state_lock(), manager.stats.phase(command):
+            if command == 'up':
+                results = [manager.add_routes()]
+            elif command == 'down':
+                results = [manager.remove_routes()]
+            elif command == 'import':
+                results = manager.import_feeds()
+            else:
+                manager.load_config()
+                results = manager.reload_routes()
+        manager.stats.count('commands', command=command)
+        return {'ok': not any(result.failed for result in results),
+                **{result.command: {'ok': len(result.ok), 'skipped': len(result.skipped),
+                                    'failed': len(result.failed)} for result in results}}
+
+    def status(self, interface: str) -> dict:
+        manager = self.managers[interface]
+        return {'ok': True,
+                'interface': interface,
+                'address': getattr(manager, 'iface_ip', None),
+                'config': manager.config_file,
+                'routes': len(manager.routes),
+                'installed': len(manager.journal),
+                'pid': os.getpid(),
+                'uptime': round(time.time() - self.started, 1)}
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class RouteDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            message = rcontrol.decode(line)
+            reply = self.server.handle_command(message.get('command'), message.get('interface'))
+        except Exception as e:
+            reply = {'ok': False, 'error': str(e)}
+        self.wfile.write(rcontrol.encode(reply))
+
+
+def serve_daemon(managers: dict, socket_path: str, stats_file: str = None):
+    """Запускает демон и работает до SIGTERM/SIGINT"""
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    with RouteDaemon(managers, socket_path, stats_file) as daemon:
+        print(f"[+] Демон слушает {socket_path}, интерфейсы {', '.join(managers)}")
+        try:
+            daemon.serve_forever()
+        finally:
+            print("[+] Демон остановлен")
+
+def parse_tunnel(value: str):
+    """IFACE=CONFIG для --tunnel"""
+    interface, sep, config_file = value.partition('=')
+    if not sep or not interface or not config_file:
+        raise argparse.ArgumentTypeError(f"ожидается ИНТЕРФЕЙС=КОНФИГ, а не {value}")
+    return interface, config_file
+
+
+def run_state(manager: RouteManager, state: str, args=None, plan: rplan.Plan = None) -> bool:
+    """Одна команда up/down/reload/import/apply/watch/domains для туннеля"""
+    if not manager.get_interface_ip(manager.iface_name):
+        return False
+    if state == 'watch':
+        # Долгие режимы файл состояния не блокируют, иначе повиснет down из хука OpenVPN
+        manager.watch()
+    elif state == 'domains':
+        serve_domains(manager, args.listen, args.upstream)
+    else:
+        with manager.state_lock(), manager.stats.phase(state):
+            if state == 'up':
+                manager.add_routes()
+            elif state == 'down':
+                manager.remove_routes()
+            elif state == 'reload':
+                manager.reload_routes()
+            elif state == 'import':
+                manager.import_feeds()
+            elif state == 'apply':
+                added, replaced, removed = manager.apply_plan(plan)
+                print(f"[+] План {plan.command} для {manager.iface_name}: добавлено {len(added.ok)}, "
+                      f"заменено {len(replaced.ok)}, удалено {len(removed.ok)}")
+    return True
+
+
+def plan_state(manager: RouteManager, state: str):
+    """План команды up/down/reload для туннеля, без изменений в ядре"""
+    if not manager.get_interface_ip(manager.iface_name):
+        return None
+    with manager.state_lock(), manager.stats.phase('plan'):
+        return manager.plan(state)
+
+
+def serve_domains(manager: RouteManager, listen: str, upstream: str = None):
+    """Маршруты по доменам из route-domain, до SIGTERM/SIGINT"""
+    import rdomains
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    with rconfig.RouteConfig(manager.config_file, lazy=True) as config:
+        domains = list(config.iter_domains())
+    if not domains:
+        print(f"[-] В {manager.config_file} нет строк route-domain")
+        return
+    signal.signal(signal.SIGTERM, stop)
+    router = rdomains.DomainRouter(manager, domains, listen=listen,
+                                   upstream=upstream.split(',') if upstream else None)
+    router.serve()
+
+
 def main():
+    # lookup не трогает интерфейсы, у него свои аргументы
+    if len(sys.argv) > 1 and sys.argv[1] == 'lookup':
+        import rlpm
+        return rlpm.main(sys.argv[2:])
+
+    # Аргументы от OpenVPN — в лог хука; вывод lookup разбирают скрипты, ему не нужно
+    print(sys.argv)
+
     # Создаем парсер аргументов
     parser = argparse.ArgumentParser(description="Добавление и удаление маршрутов интерфейса")
 
     # Добавляем аргумент up/down (позиционный)
     parser.add_argument(
         "state",
-        choices=["up", "down", "reload"],  # Ограничиваем только значениями up или down
+        choices=["up", "down", "reload", "import", "apply", "daemon", "watch", "domains"],  # Ограничиваем только значениями up или down
         help="Состояние интерфейса (up или down). Пример: up"
     )
     
     # Добавляем обязательный аргумент config с format config=<file>
     parser.add_argument(
-        "--config", required=True, type=str, help="Путь к файлу конфигурации. Пример: --config=routes.conf"
+        "--config", type=str, help="Путь к файлу конфигурации. Пример: --config=routes.conf"
     )
 
-    # Добавляем обязательный аргумент interface с format interface=<name>
+    # Добавляем аргумент interface с format interface=<name>, без --tunnel он обязателен
+    parser.add_argument(
+        "interface", type=str, nargs='?', help="Имя интерфейса. Пример: tun0"
+    )
+    parser.add_argument(
+        "--tunnel", type=parse_tunnel, action="append", default=[],
+        help="Туннель ИНТЕРФЕЙС=КОНФИГ, можно повторять: все туннели обрабатываются параллельно"
+    )
     parser.add_argument(
-        "interface", type=str, help="Имя интерфейса. Пример: tun0"
+        "--state-dir", type=str, default=None,
+        help="Каталог файлов состояния current_routes.<интерфейс>.json "
+             f"(по умолчанию {CURRENT_ROUTES_FILE}, а с --tunnel — текущий каталог)"
+    )
+    
+    parser.add_argument(
+        "--window", type=int, default=rnetlink.DEFAULT_WINDOW,
+        help="Потолок окна: сколько netlink-запросов отправлять, не дожидаясь ACK. 1 — по одному"
+    )
+    parser.add_argument(
+        "--rcvbuf", type=int, default=rnetlink.DEFAULT_RCVBUF,
+        help="Начальный буфер приёма netlink-сокета, байт (при ENOBUFS удваивается)"
+    )
+    parser.add_argument(
+        "--dns-workers", type=int, default=rresolver.DNS_WORKERS,
+        help="Сколько доменных имён разрешать одновременно"
+    )
+    parser.add_argument(
+        "--dns-timeout", type=float, default=rresolver.DNS_TIMEOUT,
+        help="Таймаут разрешения одного имени, секунд"
+    )
+    parser.add_argument(
+        "--dns-cache", type=str, default=None,
+        help=f"Файл кэша DNS (по умолчанию {rdnscache.DNS_CACHE_FILE}, а с --state-dir — "
+             "dns_cache.<интерфейс>.json в нём). Пустая строка — без кэша"
+    )
+    parser.add_argument(
+        "--no-aggregate", dest="aggregate", action="store_false",
+        help="Не объединять вложенные и соседние сети перед установкой"
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Ставить маршруты по мере чтения конфига (для очень больших файлов, без агрегации)"
+    )
+    parser.add_argument(
+        "--route-cache", type=str, default=None,
+        help="Двоичный кэш разобранного конфига (по умолчанию <config>.rcache). Пустая строка — без кэша"
+    )
+    parser.add_argument(
+        "--listen", type=str, default="127.0.0.1:53",
+        help="Адрес DNS-сервера режима domains"
+    )
+    parser.add_argument(
+        "--upstream", type=str, default=None,
+        help="Вышестоящие DNS-серверы режима domains через запятую (по умолчанию из resolv.conf)"
+    )
+    parser.add_argument(
+        "--socket", type=str, default=rcontrol.SOCKET_PATH,
+        help="Unix-сокет управления для режима daemon"
+    )
+    parser.add_argument(
+        "--table", type=int, default=None,
+        help="Ставить маршруты в таблицы N и N+1 и переключать трафик правилом ip rule"
+    )
+    parser.add_argument(
+        "--rule-priority", type=int, default=RULE_PRIORITY,
+        help="Приоритет правила ip rule для режима --table"
+    )
+    parser.add_argument(
+        "--proto", type=int, default=RT_PROTO,
+        help="Метка proto наших маршрутов (1-255): down и reload находят их по ней в ядре"
+    )
+    parser.add_argument(
+        "--domain-proto", type=int, default=RT_DOMAIN_PROTO,
+        help="Метка proto маршрутов по доменам (domains), отличная от --proto"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Для up, down и reload: только показать, что изменится в ядре"
+    )
+    parser.add_argument(
+        "--plan", type=str, default=None,
+        help="Файл плана: с --dry-run — куда сохранить, для apply — что выполнить"
+    )
+    parser.add_argument(
+        "--stats", type=str, default=None,
+        help="Куда сохранить замеры: *.prom — для textfile-коллектора Prometheus, иначе JSON"
     )
     
     # tun0 1500 0 10.109.154.78 255.255.248.0 init
@@ -171,28 +965,105 @@ def main():
     parser.add_argument("regime", nargs='*', help="Режим инициализации (может быть init или restart).")
 
     # Разобираем аргументы
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
+
+    plans = {}
+    if args.dry_run and args.state not in rplan.COMMANDS:
+        parser.error("--dry-run работает только с up, down и reload")
+    if (args.dry_run or args.state == 'apply') and args.table is not None:
+        parser.error("план строится только для основной таблицы, без --table")
+    if args.state == 'apply':
+        # Туннели, конфиги и файлы состояния берутся из плана; интерфейс — фильтр
+        if not args.plan:
+            parser.error("для apply нужен --plan=ФАЙЛ")
+        plans = {plan.interface: plan for plan in rplan.load(args.plan)
+                 if not args.interface or plan.interface == args.interface}
+        if not plans:
+            parser.error(f"в {args.plan} нет плана для {args.interface}")
+        tunnels = [(interface, plan.config_file) for interface, plan in plans.items()]
+    else:
+        tunnels = list(args.tunnel)
+        if args.interface or args.config:
+            if not (args.interface and args.config):
+                parser.error("нужны и --config, и интерфейс")
+            tunnels.insert(0, (args.interface, args.config))
+    if not tunnels:
+        parser.error("нужны --config и интерфейс или хотя бы один --tunnel")
+    if len({interface for interface, _ in tunnels}) != len(tunnels):
+        parser.error("интерфейс указан несколько раз")
+    if args.state in ('watch', 'domains') and len(tunnels) > 1:
+        parser.error(f"{args.state} работает с одним интерфейсом")
+    if args.table is not None and len(tunnels) > 1:
+        parser.error("--table работает с одним интерфейсом: таблицы и правило у туннелей были бы общими")
+    state_dir = args.state_dir
+    if state_dir is None and len(tunnels) > 1:
+        state_dir = '.'
+    if state_dir is not None:
+        # Иначе блокировка файла состояния упадёт с ENOENT
+        os.makedirs(state_dir, exist_ok=True)
 
     # Выводим результаты
-    print(f"Имя интерфейса: {args.interface}")
+    for interface, config_file in tunnels:
+        print(f"Имя интерфейса: {interface}")
+        print(f"Файл конфигурации: {config_file}")
     print(f"Состояние: {args.state}")
-    print(f"Файл конфигурации: {args.config}")
-    
-    with RouteManager(config_file=args.config) as manager:
-        res = manager.get_interface_ip(args.interface)
-        if res:
-            if args.state == 'up':
-                manager.add_routes()
-            elif args.state == 'down':
-                manager.remove_routes()
-            elif args.state == 'reload':
-                manager.remove_routes()
-                manager.add_routes ()
+
+    def open_manager(tunnel):
+        interface, config_file = tunnel
+        route_cache = args.route_cache
+        if route_cache is None:
+            route_cache = rcache.cache_path(config_file)
+        plan = plans.get(interface)
+        dns_cache = args.dns_cache
+        if dns_cache is None:
+            dns_cache = dns_cache_file(interface, state_dir)
+        return RouteManager(config_file=config_file, iface_name=interface, window=args.window, rcvbuf=args.rcvbuf,
+                            current_routes_file=plan.state_file if plan else state_file(interface, state_dir),
+                            dns_workers=args.dns_workers, dns_timeout=args.dns_timeout,
+                            dns_cache=dns_cache, aggregate=args.aggregate, stream=args.stream,
+                            route_cache=route_cache, table=args.table,
+                            rule_priority=args.rule_priority, proto=plan.proto if plan else args.proto,
+                            domain_proto=args.domain_proto,
+                            stats=rstats.Stats(interface=interface))
+
+    def open_daemon_manager(tunnel):
+        # Демон разбирает конфиги сразу: ради этого он и держится в памяти
+        manager = open_manager(tunnel)
+        manager.load_config()
+        return manager
+
+    # Конфиги разбираются, а маршруты ставятся параллельно по туннелям
+    with ThreadPoolExecutor(max_workers=len(tunnels)) as executor:
+        managers = dict(zip((interface for interface, _ in tunnels),
+                            executor.map(open_daemon_manager if args.state == 'daemon' else open_manager,
+                                         tunnels)))
+        try:
+            if args.state == 'daemon':
+                serve_daemon(managers, args.socket, args.stats)
+                return
+            if args.dry_run:
+                planned = [plan for plan in executor.map(lambda manager: plan_state(manager, args.state),
+                                                         managers.values()) if plan is not None]
+                for plan in planned:
+                    plan.report()
+                if args.plan:
+                    rplan.save(args.plan, planned)
+                    print(f"[+] План сохранён в {args.plan}, выполнить: apply --plan={args.plan}")
+            elif len(managers) == 1:
+                # Один туннель — в главном потоке, чтобы watch получал Ctrl+C
+                run_state(managers[tunnels[0][0]], args.state, args, plans.get(tunnels[0][0]))
+            else:
+                list(executor.map(lambda manager: run_state(manager, args.state, plan=plans.get(manager.iface_name)),
+                                  managers.values()))
+        finally:
+            for manager in managers.values():
+                manager.close()
+    if args.stats:
+        rstats.save(args.stats, *(manager.stats for manager in managers.values()))
         
 if __name__ == '__main__':
     """
         ./route_manager.py up --config=tun_routes.conf tun0
         ./route_manager.py down --config=tun_routes.conf tun0
     """
-    print(sys.argv)
     main()
@@ -1,4 +1,9 @@
 # -*- mode: python ; coding: utf-8 -*-
+# Сборка хука для OpenVPN: pyinstaller route-manager.spec
+#
+# onedir, а не onefile: onefile на каждом запуске распаковывает себя во
+# временный каталог, а OpenVPN запускает хук на каждом up и down.
+# Результат — каталог dist/route-manager/ с исполняемым route-manager внутри.
 
 
 a = Analysis(
@@ -6,29 +11,38 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    # pyroute2 загружается через rpyroute по имени модуля, такие импорты
+    # анализатор не видит
+    hiddenimports=[
+        'pyroute2.iproute.linux',
+        'pyroute2.netlink.rtnl',
+        'pyroute2.netlink.exceptions',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # NumPy нужен только при первом разборе огромного конфига, дальше
+    # маршруты читаются из двоичного кэша; остальное хуку не нужно никогда.
+    # unittest исключать нельзя: pyroute2.netlink.rtnl.iprsocket импортирует
+    # unittest.mock при загрузке
+    excludes=['numpy', 'tkinter', 'pydoc', 'doctest', 'lib2to3'],
     noarchive=False,
-    optimize=0,
+    # Без docstring и assert: меньше байт-кода читать при старте
+    optimize=2,
 )
 pyz = PYZ(a.pure)
 
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='route-manager',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    # Сжатые UPX библиотеки распаковываются при каждом запуске
+    upx=False,
     console=True,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -36,3 +50,13 @@ exe = EXE(
     codesign_identity=None,
     entitlements_file=None,
 )
+
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='route-manager',
+)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import time
+
+# План изменений: что именно up, down или reload отправят в ядро.
+# Строится по конфигу и одному дампу маршрутов интерфейса, сохраняется в
+# JSON и потом выполняется командой apply — без разбора конфига и DNS.
+
+VERSION = 1
+COMMANDS = ('up', 'down', 'reload')
+# Порядок выполнения: сначала добавляем и заменяем, потом удаляем —
+# трафик не проваливается
+OPERATIONS = ('add', 'replace', 'del')
+SIGNS = {'add': '+', 'replace': '~', 'del': '-'}
+# Скорость для оценки времени применения, маршрутов в секунду: пакетная
+# установка (rnetlink) по замеру benchmark.py, bulk_routes_per_s
+ROUTES_PER_SECOND = 50000
+
+def plan_route(route) -> dict:
+    """Маршрут в плане: только то, что нужно для запроса netlink"""
+    metric = route['metric']
+    return {'network': route['network'], 'gateway': route['gateway'],
+            'metric': None if metric is None else int(metric)}
+
+
+def snapshot_digest(snapshot: dict) -> str:
+    """Отпечаток дампа ядра: по нему apply видит, что маршруты менялись после плана"""
+    return hashlib.sha256(json.dumps(sorted(snapshot.items())).encode()).hexdigest()
+
+
+def diff(desired: dict, installed: dict, owned, route_gateway, route_metric):
+    """Разница между конфигом и ядром: (добавить, заменить, удалить, без изменений).
+
+    desired — network -> маршрут, installed — network -> (шлюз, метрика),
+    owned — сети, которые ставили мы сами: только их можно удалять.
+    """
+    to_add = []
+    to_replace = []
+    unchanged = []
+    to_delete = []
+    for network, route in desired.items():
+        if network not in installed:
+            to_add.append(route)
+            continue
+        gateway, metric = installed[network]
+        if metric != route_metric(route):
+            # Метрика входит в ключ маршрута ядра: replace поставил бы
+            # второй маршрут, поэтому новый добавляем, а старый удаляем —
+            # если он наш. Чужой (connected, static) остаётся рядом
+            to_add.append(route)
+            if network in owned:
+                to_delete.append({'network': network, 'gateway': gateway, 'metric': metric or None})
+        elif gateway != route_gateway(route):
+            to_replace.append(route)
+        else:
+            unchanged.append(route)
+
+    to_delete += [{'network': network, 'gateway': gateway, 'metric': metric or None}
+                  for network, (gateway, metric) in installed.items()
+                  if network in owned and network not in desired]
+    return to_add, to_replace, to_delete, unchanged
+
+
+class Plan:
+    """Упорядоченный набор операций над маршрутами одного интерфейса.
+
+    unchanged — наши маршруты, которые уже стоят как надо (apply дописывает
+    их в журнал); в файл сохраняется только число всех совпавших.
+    """
+
+    def __init__ (self, command: str, interface: str, config_file: str = None, state_file: str = None,
+                  proto: int = None, snapshot: str = None):
+        self.command = command
+        self.interface = interface
+        self.config_file = config_file
+        self.state_file = state_file
+        self.proto = proto
+        self.snapshot = snapshot
+        self.created = time.time()
+        self.operations = {op: [] for op in OPERATIONS}
+        self.unchanged = []
+        self.unchanged_count = 0
+        # Новое состояние источников route-import (rimport.FeedState.feeds),
+        # None — не трогать, {} — очистить
+        self.feeds = None
+
+    def extend(self, op: str, routes):
+        self.operations[op] += [plan_route(route) for route in routes]
+
+    def __len__ (self):
+        return sum(len(routes) for routes in self.operations.values())
+
+    def counts(self) -> dict:
+        return {**{op: len(routes) for op, routes in self.operations.items()},
+                'unchanged': max(len(self.unchanged), self.unchanged_count)}
+
+    def estimate(self) -> float:
+        """Примерное время применения, секунд"""
+        return len(self) / ROUTES_PER_SECOND
+
+    def summary(self) -> str:
+        counts = self.counts()
+        return (f"Изменения для {self.interface}: добавить {counts['add']}, заменить {counts['replace']}, "
+                f"удалить {counts['del']}, без изменений {counts['unchanged']}")
+
+    def report(self, operations: bool = True):
+        """Печатает план: каждую операцию и итог с оценкой времени"""
+        if operations:
+            for op in OPERATIONS:
+                for route in self.operations[op]:
+                    gateway = '' if route['gateway'] is None else f" {route['gateway']}"
+                    metric = '' if route['metric'] is None else f" metric {route['metric']}"
+                    print(f"{SIGNS[op]} {op} {route['network']}{gateway}{metric}")
+        print(f"[+] {self.summary()}, примерно {self.estimate():.1f} с")
+
+    def to_dict(self) -> dict:
+        data = {'command': self.command,
+                'interface': self.interface,
+                'config': self.config_file,
+                'state_file': self.state_file,
+                'proto': self.proto,
+                'snapshot': self.snapshot,
+                'created': self.created,
+                'counts': self.counts(),
+                'estimated_seconds': round(self.estimate(), 3),
+                # Списки, а не словари: в плане бывают сотни тысяч маршрутов
+                'operations': [[op, route['network'], route['gateway'], route['metric']]
+                               for op in OPERATIONS for route in self.operations[op]]}
+        if self.feeds is not None:
+            data['feeds'] = self.feeds
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        plan = cls(data['command'], data['interface'], data.get('config'), data.get('state_file'),
+                   data.get('proto'), data.get('snapshot'))
+        plan.created = data.get('created', plan.created)
+        plan.unchanged_count = data.get('counts', {}).get('unchanged', 0)
+        for op, network, gateway, metric in data['operations']:
+            if op not in plan.operations:
+                raise ValueError(f"Неизвестная операция {op} в плане")
+            plan.operations[op].append({'network': network, 'gateway': gateway, 'metric': metric})
+        plan.feeds = data.get('feeds')
+        return plan
+
+
+def save(path: str, plans):
+    """Пишет планы (по одному на туннель) в JSON, файл подменяется целиком"""
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': VERSION, 'created': time.time(),
+                   'plans': [plan.to_dict() for plan in plans]}, f)
+    os.replace(tmp_file, path)
+
+
+def load(path: str) -> list:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get('version') != VERSION:
+        raise ValueError(f"План {path}: версия {data.get('version')}, ожидается {VERSION}")
+    return [Plan.from_dict(item) for item in data['plans']]
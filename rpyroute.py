@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import importlib
+import importlib.util
+import sys
+
+# pyroute2/__init__.py при импорте тянет весь пакет: NDB, CLI, IPDB, ipset,
+# nl80211 и ещё пару десятков модулей — около 250 мс на каждом запуске
+# хука OpenVPN, хотя нужны только IPRoute и константы netlink. Здесь
+# подмодули загружаются без выполнения __init__.py пакета.
+
+PACKAGE = 'pyroute2'
+
+def _package():
+    """Пакет pyroute2 без выполнения __init__.py: только __path__ для подмодулей"""
+    package = sys.modules.get(PACKAGE)
+    if package is not None:
+        return package
+    spec = importlib.util.find_spec(PACKAGE)
+    if spec is None:
+        raise ImportError(f"{PACKAGE} не установлен", name=PACKAGE)
+    package = importlib.util.module_from_spec(spec)
+
+    def full(name):
+        # Кто-то просит имя из самого пакета (from pyroute2 import NDB):
+        # сначала это может быть подмодуль, иначе выполняем __init__.py целиком
+        try:
+            return importlib.import_module(f'{PACKAGE}.{name}')
+        except ModuleNotFoundError as e:
+            if e.name != f'{PACKAGE}.{name}':
+                raise
+        del package.__getattr__
+        spec.loader.exec_module(package)
+        try:
+            return package.__dict__[name]
+        except KeyError:
+            raise AttributeError(f"module {PACKAGE!r} has no attribute {name!r}") from None
+
+    package.__getattr__ = full
+    sys.modules[PACKAGE] = package
+    return package
+
+
+def module(name: str):
+    """Подмодуль pyroute2 по имени ('iproute.linux')"""
+    _package()
+    return importlib.import_module(f'{PACKAGE}.{name}')
+
+
+def IPRoute(**kwargs):
+    return module('iproute.linux').IPRoute(**kwargs)
+
+
+def AsyncIPRoute(**kwargs):
+    return module('iproute.linux').AsyncIPRoute(**kwargs)
+
+
+def rtnl():
+    """Константы rtnetlink (группы RTMGRP_* и т. п.)"""
+    return module('netlink.rtnl')
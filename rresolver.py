@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import asyncio
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import rdns
+
+# Сколько имён разрешаем одновременно
+DNS_WORKERS = 32
+# Сколько секунд ждём ответа DNS на одно имя (A и AAAA вместе); ещё
+# столько же остаётся системному резолверу, если DNS молчит
+DNS_TIMEOUT = 5.0
+# TTL для ответов без TTL (из /etc/hosts или системного резолвера)
+DNS_DEFAULT_TTL = 300
+
+class Resolver:
+    """Параллельно разрешает доменные имена во все их A- и AAAA-записи.
+
+    Если передан кэш (rdnscache.DnsCache), свежие ответы берутся из него
+    без запросов, протухшие используются сразу и обновляются в фоне.
+    """
+
+    def __init__ (self, workers: int = DNS_WORKERS, timeout: float = DNS_TIMEOUT, cache=None):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.cache = cache
+        self.servers = rdns.nameservers()
+        # Как у системного резолвера: сначала /etc/hosts, потом DNS
+        self.hosts = rdns.hosts()
+        self.failed = []
+        self.refresher = None
+
+    def lookup(self, hostname):
+        """Все адреса IPv4 и IPv6 имени без повторов и TTL ответа"""
+        if hostname.lower() in self.hosts:
+            return list(self.hosts[hostname.lower()]), DNS_DEFAULT_TTL
+        addrs = []
+        ttls = []
+        # Оба запроса укладываются в timeout, чтобы осталось время на getaddrinfo
+        deadline = time.monotonic() + self.timeout
+        for qtype in (rdns.TYPE_A, rdns.TYPE_AAAA):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                found, ttl = rdns.query(hostname, qtype=qtype, servers=self.servers,
+                                        timeout=remaining / max(1, len(self.servers)))
+            except rdns.DnsError as e:
+                if e.rcode == rdns.RCODE_NXDOMAIN:
+                    break
+                continue
+            if found:
+                addrs += found
+                ttls.append(ttl)
+        if addrs:
+            return addrs, min(ttls)
+        # Сервер недоступен или имени нет в DNS — пусть решает системный резолвер (nsswitch)
+        infos = socket.getaddrinfo(hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos)), DNS_DEFAULT_TTL
+
+    def resolve(self, hostnames) -> dict:
+        """Разрешает имена параллельно, возвращает {имя: [адреса]}.
+
+        Имена, которые не разрешились или не уложились в timeout,
+        в словарь не попадают и складываются в self.failed.
+        """
+        hostnames = list(dict.fromkeys(hostnames))
+        resolved = {}
+        stale = []
+        misses = []
+        for hostname in hostnames:
+            cached = self.cache.get(hostname) if self.cache is not None else None
+            if cached is None:
+                misses.append(hostname)
+                continue
+            addrs, fresh = cached
+            resolved[hostname] = addrs
+            if not fresh:
+                stale.append(hostname)
+
+        if misses:
+            resolved.update(self.run(self._resolve(misses)))
+
+        if stale:
+            # Старые адреса уже в работе, новые понадобятся в следующий раз
+            # daemon: хук OpenVPN не ждёт обновления при выходе
+            self.refresher = threading.Thread(target=self._refresh, args=(stale,), daemon=True)
+            self.refresher.start()
+        elif misses and self.cache is not None:
+            self.cache.save()
+        return resolved
+
+    def run(self, coro):
+        """asyncio.run, даже если вызваны из работающего цикла событий"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coro)
+        # Цикл событий этого потока занят вызывающим: ждём в отдельном.
+        # BulkRoute так не делает — блокирующий разбор конфига он сам читает
+        # в отдельном потоке (run(blocking=True)), где цикла событий нет
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coro).result()
+
+    def _refresh(self, hostnames):
+        # Если DNS недоступен, запись в кэше остаётся прежней
+        asyncio.run(self._resolve(hostnames, report=False))
+        self.cache.save()
+
+    def wait(self):
+        """Дожидается фонового обновления кэша (резидентному режиму и замерам)"""
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+
+    async def _resolve(self, hostnames, report=True):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        limit = asyncio.Semaphore(self.workers)
+        resolved = {}
+
+        async def one(hostname):
+            async with limit:
+                try:
+                    # timeout на DNS и столько же на системный резолвер
+                    addrs, ttl = await asyncio.wait_for(
+                        loop.run_in_executor(executor, self.lookup, hostname), 2 * self.timeout)
+                except (socket.gaierror, UnicodeError, asyncio.TimeoutError) as e:
+                    if report:
+                        self.failed.append((hostname, e))
+                    return
+                resolved[hostname] = addrs
+                if self.cache is not None:
+                    self.cache.put(hostname, addrs, ttl)
+
+        try:
+            await asyncio.gather(*(one(hostname) for hostname in hostnames))
+        finally:
+            # Зависшие запросы не ждём — их результат уже никому не нужен
+            executor.shutdown(wait=False, cancel_futures=True)
+        return resolved
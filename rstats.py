@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Замеры работы route-manager: время фаз, счётчики и гистограммы задержек.
+# Сохраняются в JSON или в формате textfile-коллектора Prometheus (*.prom).
+
+# Префикс имён метрик Prometheus
+PREFIX = 'route_manager'
+# Границы корзин гистограммы задержек, секунд
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: tuple, sep: str = ',', quote: str = '"') -> str:
+    return sep.join(f'{name}={quote}{value}{quote}' for name, value in key)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как у Prometheus"""
+
+    def __init__ (self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина — всё, что больше самой широкой границы
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Пары (граница, сколько значений не больше неё), последняя — +Inf"""
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self) -> dict:
+        return {'buckets': {str(bound): count for bound, count in self.cumulative()},
+                'sum': round(self.sum, 6),
+                'count': self.count}
+
+
+class Stats:
+    """Замеры одного туннеля. Методы можно вызывать из разных потоков.
+
+    labels — постоянные метки всех метрик, например interface='tun0'.
+    """
+
+    def __init__ (self, **labels):
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """Прибавляет время блока with к фазе name.
+
+        Фазы могут быть вложенными: время dns входит и в config.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name: str, value: int = 1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self) -> dict:
+        """Все замеры словарём для JSON; метки счётчиков — строкой "k=v,k=v" """
+        with self.lock:
+            counters = {}
+            for (name, key), value in self.counters.items():
+                counters.setdefault(name, {})[format_labels(key, quote='')] = value
+            histograms = {}
+            for (name, key), histogram in self.histograms.items():
+                histograms.setdefault(name, {})[format_labels(key, quote='')] = histogram.to_dict()
+            return {'timestamp': time.time(),
+                    **self.labels,
+                    'uptime': round(time.time() - self.started, 3),
+                    'phases': {name: round(value, 6) for name, value in self.phases.items()},
+                    'counters': counters,
+                    'histograms': histograms}
+
+    def samples(self):
+        """Тройки (семейство метрик, тип, строка значения) для Prometheus"""
+        const = label_key(self.labels)
+        with self.lock:
+            for name, value in self.phases.items():
+                labels = format_labels(const + (('phase', name),))
+                yield f'{PREFIX}_phase_seconds', 'gauge', f'{PREFIX}_phase_seconds{{{labels}}} {value:.6f}'
+
+            for (name, key), value in self.counters.items():
+                family = f'{PREFIX}_{name}_total'
+                labels = format_labels(const + key)
+                yield family, 'counter', f'{family}{{{labels}}} {value}' if labels else f'{family} {value}'
+
+            for (name, key), histogram in self.histograms.items():
+                family = f'{PREFIX}_{name}'
+                labels = format_labels(const + key)
+                prefix = labels + ',' if labels else ''
+                for bound, count in histogram.cumulative():
+                    yield family, 'histogram', f'{family}_bucket{{{prefix}le="{bound}"}} {count}'
+                suffix = f'{{{labels}}}' if labels else ''
+                yield family, 'histogram', f'{family}_sum{suffix} {histogram.sum:.6f}'
+                yield family, 'histogram', f'{family}_count{suffix} {histogram.count}'
+
+    def prometheus(self) -> str:
+        return prometheus(self)
+
+    def save(self, path: str):
+        save(path, self)
+
+
+def prometheus(*stats) -> str:
+    """Текст в формате textfile-коллектора node_exporter.
+
+    Строки одного семейства должны идти подряд под одним # TYPE,
+    поэтому замеры нескольких туннелей сначала группируются.
+    """
+    families = {}
+    for item in stats:
+        for family, kind, line in item.samples():
+            families.setdefault(family, (kind, []))[1].append(line)
+    lines = []
+    for family, (kind, samples) in families.items():
+        lines.append(f'# TYPE {family} {kind}')
+        lines += samples
+    return '\n'.join(lines) + '\n'
+
+
+def save(path: str, *stats):
+    """Пишет замеры в path: *.prom — для Prometheus, остальное — JSON.
+
+    Файл подменяется целиком, коллектор не увидит его недописанным.
+    Замеры нескольких туннелей в JSON складываются в список tunnels.
+    """
+    if path.endswith('.prom'):
+        text = prometheus(*stats)
+    elif len(stats) == 1:
+        text = json.dumps(stats[0].snapshot(), indent=2) + '\n'
+    else:
+        text = json.dumps({'timestamp': time.time(),
+                           'tunnels': [item.snapshot() for item in stats]}, indent=2) + '\n'
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'[-] Не удалось сохранить статистику в {path}: {e}')
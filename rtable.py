@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import socket
+import struct
+from array import array
+
+# Маска -> длина префикса для всех допустимых масок IPv4
+NETMASKS = {socket.inet_ntoa(struct.pack('!I', (0xFFFFFFFF << (32 - plen)) & 0xFFFFFFFF)): plen
+            for plen in range(33)}
+
+# Метрика не задана
+NO_METRIC = -1
+# Метрика, которую ядро ставит маршруту IPv6 без метрики (IP6_RT_PRIO_USER)
+IP6_DEFAULT_METRIC = 1024
+
+def ip_to_int(address: str) -> int:
+    """Точечная запись IPv4 в число. Только полные четыре октета"""
+    return struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+
+
+def int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def ip6_to_int(address: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, address), 'big')
+
+
+def int_to_ip6(value: int) -> str:
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+
+def format_prefix(network: int, prefixlen: int, family=socket.AF_INET) -> str:
+    address = int_to_ip6(network) if family == socket.AF_INET6 else int_to_ip(network)
+    return f'{address}/{prefixlen}'
+
+
+def address_family(address: str):
+    """AF_INET или AF_INET6 для адреса, None — если это не адрес"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, address)
+            return family
+        except OSError:
+            pass
+    return None
+
+
+def family_bits(family) -> int:
+    return 128 if family == socket.AF_INET6 else 32
+
+
+def default_metric(network: str) -> int:
+    """Метрика маршрута без метрики в ядре: 0 у IPv4, 1024 у IPv6"""
+    return IP6_DEFAULT_METRIC if ':' in network else 0
+
+
+def mask_to_prefixlen(mask: str) -> int:
+    """255.255.255.0 или 24 -> 24, ValueError для неправильной маски"""
+    if mask in NETMASKS:
+        return NETMASKS[mask]
+    if mask.isdigit() and int(mask) <= 32:
+        return int(mask)
+    raise ValueError(f'Неправильная маска {mask}')
+
+
+def prefixlen_to_mask(prefixlen: int, bits: int = 32) -> int:
+    return ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+
+
+def collapse(prefixes, bits: int = 32):
+    """Убирает дубли и вложенные сети, склеивает соседние.
+
+    prefixes — пары (сеть числом, длина префикса), результат отсортирован.
+    """
+    out = []
+    for network, prefixlen in sorted(set(prefixes)):
+        if out:
+            last_network, last_prefixlen = out[-1]
+            if network < last_network + (1 << (bits - last_prefixlen)):
+                # Сети отсортированы, так что покрыть может только последняя
+                continue
+        out.append((network, prefixlen))
+        while len(out) >= 2:
+            (first, first_len), (second, second_len) = out[-2], out[-1]
+            size = 1 << (bits - first_len)
+            if first_len != second_len or first_len == 0 or first & size or second != first + size:
+                break
+            out[-2:] = [(first, first_len - 1)]
+    return out
+
+
+class Route:
+    """Строка RouteTable, читается как старый dict маршрута"""
+    __slots__ = ('table', 'index')
+
+    KEYS = ('network', 'address', 'netmask', 'metric', 'gateway', 'comment')
+
+    def __init__ (self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__ (self, key):
+        table, i = self.table, self.index
+        if key == 'network':
+            return f'{table.address(i)}/{table.prefixlens[i]}'
+        if key == 'address':
+            return table.address(i)
+        if key == 'netmask':
+            if table.families[i] == socket.AF_INET6:
+                return int_to_ip6(prefixlen_to_mask(table.prefixlens[i], 128))
+            return int_to_ip(prefixlen_to_mask(table.prefixlens[i]))
+        if key == 'metric':
+            metric = table.metrics[i]
+            return None if metric == NO_METRIC else str(metric)
+        if key == 'gateway':
+            return table.gateway_names[table.gateways[i]]
+        if key == 'comment':
+            return ""
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.KEYS
+
+    def __iter__ (self):
+        return iter(self.KEYS)
+
+    def __repr__ (self):
+        return repr(dict(self))
+
+
+class RouteTable:
+    """Маршруты в колонках array: сеть, длина префикса, номер шлюза, метрика.
+
+    Шлюзы хранятся один раз в gateway_names, в строке — только номер.
+    Сеть IPv6 не влезает в 'I': она лежит двумя половинами в networks6,
+    а в networks у такой строки — номер пары. Семейство строки — в families.
+    Колонки могут быть memoryview поверх mmap (см. rcache), тогда они
+    копируются в array только при первом изменении.
+    """
+
+    def __init__ (self):
+        self.networks = array('I')
+        self.prefixlens = array('B')
+        self.gateways = array('H')
+        self.metrics = array('l')
+        self.families = array('B')
+        self.networks6 = array('Q')
+        self.gateway_names = []
+        self.gateway_ids = {}
+        self.buffer = None
+
+    def materialize(self):
+        """Переносит колонки из общего буфера в собственные array"""
+        if self.buffer is None:
+            return
+        self.networks = array('I', self.networks)
+        self.prefixlens = array('B', self.prefixlens)
+        self.gateways = array('H', self.gateways)
+        self.metrics = array('l', self.metrics)
+        self.families = array('B', self.families)
+        self.networks6 = array('Q', self.networks6)
+        self.buffer = None
+
+    def gateway_id(self, gateway) -> int:
+        if gateway not in self.gateway_ids:
+            self.gateway_ids[gateway] = len(self.gateway_names)
+            self.gateway_names.append(gateway)
+        return self.gateway_ids[gateway]
+
+    def append(self, network: int, prefixlen: int, metric=None, gateway='vpn_gateway',
+               family=socket.AF_INET):
+        self.materialize()
+        if family == socket.AF_INET6:
+            self.networks.append(len(self.networks6) // 2)
+            self.networks6.append(network >> 64)
+            self.networks6.append(network & 0xFFFFFFFFFFFFFFFF)
+        else:
+            self.networks.append(network)
+        self.prefixlens.append(prefixlen)
+        self.gateways.append(self.gateway_id(gateway))
+        self.metrics.append(NO_METRIC if metric is None else int(metric))
+        self.families.append(family)
+
+    def clear(self):
+        self.__init__()
+
+    def network(self, i) -> int:
+        """Сеть строки числом (для IPv6 — собранная из двух половин)"""
+        if self.families[i] == socket.AF_INET6:
+            pair = self.networks[i] * 2
+            return self.networks6[pair] << 64 | self.networks6[pair + 1]
+        return self.networks[i]
+
+    def address(self, i) -> str:
+        if self.families[i] == socket.AF_INET6:
+            return int_to_ip6(self.network(i))
+        return int_to_ip(self.networks[i])
+
+    def group_key(self, i):
+        """Ключ группы для агрегации: (семейство, шлюз, метрика)"""
+        return self.families[i], self.gateways[i], self.metrics[i]
+
+    def __len__ (self):
+        return len(self.networks)
+
+    def __getitem__ (self, i):
+        if isinstance(i, slice):
+            return [Route(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Route(self, i)
+
+    def __iter__ (self):
+        for i in range(len(self)):
+            yield Route(self, i)
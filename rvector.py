@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import socket
+
+import rtable
+
+# Векторная обработка больших списков префиксов. NumPy необязателен:
+# без него те же функции работают на чистом Python. Импортируется он при
+# первой большой пачке: это ~100 мс, которые хуку с кэшем или down не нужны.
+np = None
+_imported = False
+
+# Меньше этого числа строк массивы не окупаются
+MIN_VECTOR_SIZE = 256
+
+def available() -> bool:
+    global np, _imported
+    if not _imported:
+        _imported = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+    return np is not None
+
+
+def _pack(addresses):
+    """Адреса в байты по 4 на штуку; неправильные — нули и флаг ошибки"""
+    inet_pton = socket.inet_pton
+    chunks = []
+    errors = []
+    for i, address in enumerate(addresses):
+        try:
+            chunks.append(inet_pton(socket.AF_INET, address))
+        except OSError:
+            chunks.append(b'\0\0\0\0')
+            errors.append(i)
+    return b''.join(chunks), errors
+
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    values = values.astype(np.uint64)
+    values = values - ((values >> 1) & 0x55555555)
+    values = (values & 0x33333333) + ((values >> 2) & 0x33333333)
+    values = (values + (values >> 4)) & 0x0F0F0F0F
+    return ((values * 0x01010101) & 0xFFFFFFFF) >> 24
+
+
+def parse_columns(addresses, masks):
+    """Колонки адресов и масок -> (сети uint32, длины префиксов, годные строки).
+
+    Маска может быть точечной или длиной префикса. Строка негодна, если
+    адрес или маска неправильные или у адреса есть биты хоста — такие
+    строки вызывающий разбирает обычным путём, чтобы напечатать ошибку.
+    """
+    if not available():
+        return _parse_columns_python(addresses, masks)
+
+    packed, bad_addresses = _pack(addresses)
+    networks = np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+
+    # Длину префикса в маску, чтобы дальше обрабатывать одинаково
+    masks = [rtable.int_to_ip(rtable.prefixlen_to_mask(int(mask)))
+             if mask.isdigit() and int(mask) <= 32 else mask for mask in masks]
+    packed, bad_masks = _pack(masks)
+    netmasks = np.frombuffer(packed, dtype='>u4').astype(np.uint32)
+
+    valid = np.ones(len(networks), dtype=bool)
+    valid[bad_addresses] = False
+    valid[bad_masks] = False
+    # Маска правильная, если её инверсия вида 0…01…1
+    inverted = ~netmasks
+    valid &= (inverted & (inverted + np.uint32(1))) == 0
+    valid &= (networks & inverted) == 0
+    prefixlens = (32 - _popcount(inverted)).astype(np.uint8)
+    return networks, prefixlens, valid
+
+
+def _parse_columns_python(addresses, masks):
+    networks, prefixlens, valid = [], [], []
+    for address, mask in zip(addresses, masks):
+        try:
+            network = rtable.ip_to_int(address)
+            prefixlen = rtable.mask_to_prefixlen(mask)
+            ok = not network & ~rtable.prefixlen_to_mask(prefixlen)
+        except (ValueError, OSError):
+            network, prefixlen, ok = 0, 0, False
+        networks.append(network)
+        prefixlens.append(prefixlen)
+        valid.append(ok)
+    return networks, prefixlens, valid
+
+
+def collapse(networks, prefixlens):
+    """Как rtable.collapse, но на массивах: пары (сеть, длина префикса)"""
+    if len(networks) < MIN_VECTOR_SIZE or not available():
+        return rtable.collapse(zip(networks, prefixlens))
+
+    networks = np.asarray(networks, dtype=np.uint64)
+    prefixlens = np.asarray(prefixlens, dtype=np.int64)
+
+    # Дубли: сортировка по (сеть, длина) и unique
+    order = np.lexsort((prefixlens, networks))
+    networks, prefixlens = networks[order], prefixlens[order]
+    keep = np.ones(len(networks), dtype=bool)
+    keep[1:] = (networks[1:] != networks[:-1]) | (prefixlens[1:] != prefixlens[:-1])
+    networks, prefixlens = networks[keep], prefixlens[keep]
+
+    # Вложенные: начало внутри любой из предыдущих сетей
+    ends = networks + (np.uint64(1) << (32 - prefixlens).astype(np.uint64))
+    reach = np.maximum.accumulate(ends)
+    keep = np.ones(len(networks), dtype=bool)
+    keep[1:] = networks[1:] >= reach[:-1]
+    networks, prefixlens = networks[keep], prefixlens[keep]
+
+    # Соседние половины склеиваем, пока есть что склеивать (не больше 32 проходов)
+    while len(networks) > 1:
+        sizes = np.uint64(1) << (32 - prefixlens).astype(np.uint64)
+        pairs = ((prefixlens[:-1] == prefixlens[1:]) & (prefixlens[:-1] > 0)
+                 & ((networks[:-1] & sizes[:-1]) == 0)
+                 & (networks[1:] == networks[:-1] + sizes[:-1]))
+        if not pairs.any():
+            break
+        # Пары не пересекаются: нижняя половина не бывает верхней
+        lower = np.flatnonzero(pairs)
+        prefixlens[lower] -= 1
+        keep = np.ones(len(networks), dtype=bool)
+        keep[lower + 1] = False
+        networks, prefixlens = networks[keep], prefixlens[keep]
+
+    return list(zip(networks.tolist(), prefixlens.tolist()))
@@ -5,12 +5,13 @@ import sys
 import os
 from datetime import datetime
 
+import rdump
+
 ROUTE_BACKUP_FILE = "/var/lib/openvpn/routes_backup.json"
 
 def get_current_routes():
     """Получает текущую таблицу маршрутизации"""
-    result = subprocess.run(['ip', 'route', 'show'], capture_output=True, text=True)
-    return result.stdout.splitlines()
+    return [route['raw'] for route in rdump.dump_routes()]
 
 def save_routes(routes):
     """Сохраняет маршруты в файл"""